@@ -0,0 +1,82 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from utils import Frame, print_with_color, artifacts
+
+arg_desc = "Latency of PNG against raw screenshot capture, on recorded captures and optionally on a live device. " \
+           "Run from the repository root."
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--png", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "screen.png"),
+                    help="Capture recorded with \"adb exec-out screencap -p > screen.png\", a 1080x2400 sample "
+                         "screen by default")
+parser.add_argument("--raw", help="The same screen recorded with \"adb exec-out screencap > screen.raw\". When not "
+                                  "given, RGBA_8888 pixels converted from the PNG capture stand in for it, which is not "
+                                  "real device output")
+parser.add_argument("--device", help="Also time complete captures of both formats on this device")
+parser.add_argument("--runs", type=int, default=20)
+args = vars(parser.parse_args())
+
+
+def timed(run, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+with open(args["png"], "rb") as f:
+    png_data = f.read()
+if args["raw"]:
+    with open(args["raw"], "rb") as f:
+        raw_data = f.read()
+else:
+    # A stand-in with a 12 byte header and RGBA_8888 pixels. Real devices may send another supported pixel format or the
+    # 16 byte header with a colour space, so only --raw or --device measure what a device actually sends.
+    image = cv2.imdecode(np.frombuffer(png_data, np.uint8), cv2.IMREAD_COLOR)
+    height, width = image.shape[:2]
+    raw_data = np.array([width, height, 1], "<u4").tobytes() + cv2.cvtColor(image, cv2.COLOR_BGR2RGBA).tobytes()
+    print_with_color("No --raw capture given, the raw input is converted from the PNG capture and is not device output",
+                     "yellow")
+
+raw_frame = Frame.from_raw(raw_data)
+if raw_frame is None:
+    print_with_color("ERROR: the raw capture has an unsupported header or pixel format", "red")
+    sys.exit(1)
+png_frame = Frame(data=png_data)
+width, height = raw_frame.size
+print_with_color(f"{width}x{height}, PNG {len(png_data) / 1e6:.2f} MB, raw {len(raw_data) / 1e6:.2f} MB", "yellow")
+if not np.array_equal(png_frame.image, raw_frame.image):
+    print_with_color("ERROR: the PNG and the raw capture do not show the same pixels", "red")
+    sys.exit(1)
+
+# Host side cost of turning the captured bytes into the BGR image the labels are drawn on
+png_ms = timed(lambda: Frame(data=png_data).image, args["runs"])
+wrap_ms = timed(lambda: Frame.from_raw(raw_data), args["runs"])
+raw_ms = timed(lambda: Frame.from_raw(raw_data).image, args["runs"])
+print_with_color(f"PNG decode: {png_ms:.1f} ms", "cyan")
+print_with_color(f"raw wrap: {wrap_ms:.3f} ms, raw to BGR: {raw_ms:.1f} ms", "cyan")
+
+if args["device"]:
+    from and_controller import AndroidController
+
+    controller = AndroidController(args["device"])
+    save_dir = tempfile.mkdtemp()
+    for screenshot_format in ("png", "raw"):
+        controller.screenshot_format = screenshot_format
+        capture_ms = timed(lambda: controller.capture_screenshot("bench", save_dir).image, args["runs"])
+        print_with_color(f"{screenshot_format} capture on {args['device']}: {capture_ms:.1f} ms", "cyan")
+    controller.close()
+    artifacts.flush()
+    for name in os.listdir(save_dir):
+        os.remove(os.path.join(save_dir, name))
+    os.rmdir(save_dir)
@@ -0,0 +1,82 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from and_controller import AndroidElement
+from utils import Frame, artifacts, draw_bbox_multi, draw_labels, print_with_color
+
+arg_desc = "Speed of the screenshot labeling against pyshine.putBText, which it replaced, on synthetic frames. Run " \
+           "from the repository root."
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--size", default="1080x2400")
+parser.add_argument("--elements", type=int, default=200)
+parser.add_argument("--runs", type=int, default=20)
+parser.add_argument("--seed", type=int, default=0)
+args = vars(parser.parse_args())
+
+
+def timed(run, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def reference_labels(image, labels, font_scale, space, thickness):
+    # The labeling as it was before draw_labels, one putBText call per label
+    for text, x, y, background, color in labels:
+        image = ps.putBText(image, text, text_offset_x=x, text_offset_y=y, vspace=space, hspace=space,
+                            font_scale=font_scale, thickness=thickness, background_RGB=background, text_RGB=color,
+                            alpha=0.5)
+    return image
+
+
+width, height = map(int, args["size"].split("x"))
+rng = random.Random(args["seed"])
+image = np.random.default_rng(args["seed"]).integers(0, 256, (height, width, 3), np.uint8)
+elem_list = []
+for i in range(args["elements"]):
+    # Keep the boxes clear of the top and left edge, where putBText slices with negative indices
+    x1, y1 = rng.randint(20, width - 100), rng.randint(20, height - 100)
+    x2, y2 = min(width, x1 + rng.randint(10, 300)), min(height, y1 + rng.randint(10, 200))
+    elem_list.append(AndroidElement(f"elem_{i}", ((x1, y1), (x2, y2)), rng.choice(["clickable", "focusable"])))
+labels = []
+for count, elem in enumerate(elem_list, 1):
+    center_x, center_y = (elem.bbox[0][0] + elem.bbox[1][0]) // 2, (elem.bbox[0][1] + elem.bbox[1][1]) // 2
+    labels.append((str(count), center_x + 10, center_y + 10, (10, 10, 10), (255, 250, 250)))
+
+labels_ms = timed(lambda: draw_labels(image.copy(), labels, 1, 10, 2), args["runs"])
+copy_ms = timed(lambda: image.copy(), args["runs"])
+print_with_color(f"{width}x{height}, {len(labels)} labels: draw_labels {labels_ms - copy_ms:.1f} ms", "cyan")
+
+save_dir = tempfile.mkdtemp()
+output_path = os.path.join(save_dir, "labeled.png")
+frame = Frame(image)
+# The labeled screenshot is written in the background, wait for it so that the write is part of the time
+multi_ms = timed(lambda: (draw_bbox_multi(frame, output_path, elem_list), artifacts.flush()), args["runs"])
+print_with_color(f"draw_bbox_multi including the PNG write: {multi_ms:.1f} ms", "cyan")
+for name in os.listdir(save_dir):
+    os.remove(os.path.join(save_dir, name))
+os.rmdir(save_dir)
+
+try:
+    import pyshine as ps
+except ImportError:
+    print_with_color("pyshine is not installed, skipping the comparison with putBText", "yellow")
+else:
+    if not np.array_equal(draw_labels(image.copy(), labels, 1, 10, 2),
+                          reference_labels(image.copy(), labels, 1, 10, 2)):
+        print_with_color("ERROR: draw_labels and putBText do not draw the same pixels", "red")
+        raise SystemExit(1)
+    reference_ms = timed(lambda: reference_labels(image.copy(), labels, 1, 10, 2), args["runs"])
+    print_with_color(f"putBText {reference_ms - copy_ms:.1f} ms, identical pixels, "
+                     f"{(reference_ms - copy_ms) / (labels_ms - copy_ms):.1f}x faster", "green")
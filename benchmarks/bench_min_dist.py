@@ -0,0 +1,135 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from and_controller import AndroidElement, configs, extract_elements, get_id_from_element
+from utils import print_with_color
+
+arg_desc = "Speed of the MIN_DIST de-duplication against the former quadratic scan, on synthetic hierarchies. Run " \
+           "from the repository root."
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--nodes", type=int, default=5000)
+parser.add_argument("--hierarchies", type=int, default=3)
+parser.add_argument("--seed", type=int, default=0)
+args = vars(parser.parse_args())
+
+
+def synthetic_hierarchy(nodes, rng, width=1080, height=2400):
+    # Nested nodes with random bounds on a phone sized screen, about half of them clickable or focusable
+    out = ["<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">"
+           f"<node index=\"0\" text=\"\" resource-id=\"\" class=\"android.widget.FrameLayout\" package=\"com.app\" "
+           f"content-desc=\"\" clickable=\"false\" focusable=\"false\" bounds=\"[0,0][{width},{height}]\">"]
+    count = 0
+
+    def build(depth):
+        nonlocal count
+        for index in range(rng.randint(1, 6)):
+            if count >= nodes:
+                return
+            count += 1
+            x1, y1 = rng.randint(0, width - 20), rng.randint(0, height - 20)
+            x2, y2 = min(width, x1 + rng.randint(10, 300)), min(height, y1 + rng.randint(10, 200))
+            resource_id = rng.choice(["", "com.app:id/button", "com.app:id/item", ""])
+            desc = rng.choice(["", "Send", "a long content description"])
+            out.append(f"<node index=\"{index}\" text=\"\" resource-id=\"{resource_id}\" "
+                       f"class=\"android.widget.Button\" package=\"com.app\" content-desc=\"{desc}\" "
+                       f"clickable=\"{rng.choice(['true', 'false'])}\" focusable=\"{rng.choice(['true', 'false'])}\" "
+                       f"bounds=\"[{x1},{y1}][{x2},{y2}]\">")
+            if depth < 8 and rng.random() < 0.5:
+                build(depth + 1)
+            out.append("</node>")
+
+    while count < nodes:
+        build(0)
+    out.append("</node></hierarchy>")
+    return "".join(out)
+
+
+# The extraction as it was before the grid index: every candidate is compared with every accepted element, once per
+# attribute, and the focusable elements once more with all clickable ones
+def reference_traverse_tree(xml_path, elem_list, attrib, add_index=False):
+    path = []
+    for event, elem in ET.iterparse(xml_path, ['start', 'end']):
+        if event == 'start':
+            path.append(elem)
+            if attrib in elem.attrib and elem.attrib[attrib] == "true":
+                parent_prefix = ""
+                if len(path) > 1:
+                    parent_prefix = get_id_from_element(path[-2])
+                bounds = elem.attrib["bounds"][1:-1].split("][")
+                x1, y1 = map(int, bounds[0].split(","))
+                x2, y2 = map(int, bounds[1].split(","))
+                center = (x1 + x2) // 2, (y1 + y2) // 2
+                elem_id = get_id_from_element(elem)
+                if parent_prefix:
+                    elem_id = parent_prefix + "_" + elem_id
+                if add_index:
+                    elem_id += f"_{elem.attrib['index']}"
+                close = False
+                for e in elem_list:
+                    bbox = e.bbox
+                    center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+                    dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
+                    if dist <= configs["MIN_DIST"]:
+                        close = True
+                        break
+                if not close:
+                    elem_list.append(AndroidElement(elem_id, ((x1, y1), (x2, y2)), attrib))
+        if event == 'end':
+            path.pop()
+
+
+def reference_extract_elements(xml_path):
+    clickable_list = []
+    focusable_list = []
+    reference_traverse_tree(xml_path, clickable_list, "clickable", True)
+    reference_traverse_tree(xml_path, focusable_list, "focusable", True)
+    elem_list = clickable_list.copy()
+    for elem in focusable_list:
+        bbox = elem.bbox
+        center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+        close = False
+        for e in clickable_list:
+            bbox = e.bbox
+            center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
+            if dist <= configs["MIN_DIST"]:
+                close = True
+                break
+        if not close:
+            elem_list.append(elem)
+    return elem_list
+
+
+def rows(elem_list):
+    return [(elem.uid, elem.bbox, elem.attrib) for elem in elem_list]
+
+
+rng = random.Random(args["seed"])
+reference_total = 0
+total = 0
+for i in range(args["hierarchies"]):
+    fd, xml_path = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, "w") as f:
+        f.write(synthetic_hierarchy(args["nodes"], rng))
+    start = time.perf_counter()
+    expected = reference_extract_elements(xml_path)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    elem_list = extract_elements(xml_path, add_index=True)
+    elapsed = time.perf_counter() - start
+    os.remove(xml_path)
+    if rows(elem_list) != rows(expected):
+        print_with_color(f"ERROR: hierarchy {i} gives different elements than the reference", "red")
+        raise SystemExit(1)
+    reference_total += reference_time
+    total += elapsed
+    print_with_color(f"hierarchy {i}: {len(elem_list)} elements, reference {reference_time * 1000:.0f} ms, "
+                     f"grid {elapsed * 1000:.0f} ms", "cyan")
+print_with_color(f"{args['hierarchies']} hierarchies of {args['nodes']} nodes, identical output, "
+                 f"{reference_total / total:.1f}x faster", "green")
@@ -0,0 +1,43 @@
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from and_controller import AndroidController, input_keyevent
+from utils import print_with_color
+
+arg_desc = "Characters per second of each text input mode, run from the repository root with a text field focused " \
+           "on the device"
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--device", required=True)
+parser.add_argument("--lengths", default="10,50,200", help="Comma separated lengths of the typed strings")
+parser.add_argument("--runs", type=int, default=3)
+parser.add_argument("--seed", type=int, default=0)
+args = vars(parser.parse_args())
+
+rng = random.Random(args["seed"])
+controller = AndroidController(args["device"])
+for mode in ("input", "adbkeyboard"):
+    controller.text_input_mode = mode
+    controller.fast_text = None
+    if mode == "adbkeyboard" and not controller.fast_text_ready():
+        print_with_color("Skipping adbkeyboard, ADBKeyboard is not the active input method", "yellow")
+        continue
+    for length in map(int, args["lengths"].split(",")):
+        elapsed = 0
+        for _ in range(args["runs"]):
+            text = "".join(rng.choice(string.ascii_letters + string.digits + " ") for _ in range(length))
+            start = time.perf_counter()
+            ret = controller.text(text)
+            elapsed += time.perf_counter() - start
+            if ret == "ERROR":
+                print_with_color(f"ERROR: {mode} failed to type {length} characters", "red")
+                break
+            # Clear the field again before the next run, which is not timed
+            controller.shell(input_keyevent("KEYCODE_MOVE_END", *["KEYCODE_DEL"] * length))
+        else:
+            print_with_color(f"{mode}, {length} characters: {length * args['runs'] / elapsed:.0f} chars/s", "cyan")
+controller.close()
@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from and_controller import CenterGrid, ElementColumns, configs, extract_elements, get_id_from_element, merge_elements
+from utils import print_with_color
+
+arg_desc = "Peak memory and time of the hierarchy walk against the same walk keeping the whole tree, measured with " \
+           "tracemalloc. Run from the repository root."
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--sizes", default="2000,10000,50000", help="Comma separated node counts")
+parser.add_argument("--depth", type=int, default=200, help="Nesting depth of the deep hierarchies")
+parser.add_argument("--seed", type=int, default=0)
+args = vars(parser.parse_args())
+
+
+def node(rng, index, width=1080, height=2400):
+    # WebView nodes tend to carry long texts, which is what makes their dumps so large
+    x1, y1 = rng.randint(0, width - 20), rng.randint(0, height - 20)
+    x2, y2 = min(width, x1 + rng.randint(10, 300)), min(height, y1 + rng.randint(10, 200))
+    text = " ".join(rng.choice(["lorem", "ipsum", "dolor", "sit", "amet"]) for _ in range(rng.randint(0, 30)))
+    return f"<node index=\"{index}\" text=\"{text}\" resource-id=\"\" class=\"android.view.View\" " \
+           f"package=\"com.android.chrome\" content-desc=\"\" clickable=\"{rng.choice(['true', 'false'])}\" " \
+           f"focusable=\"{rng.choice(['true', 'false'])}\" bounds=\"[{x1},{y1}][{x2},{y2}]\">"
+
+
+def root_node(width=1080, height=2400):
+    return "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\"><node index=\"0\" " \
+           "text=\"\" resource-id=\"\" class=\"android.widget.FrameLayout\" package=\"com.android.chrome\" " \
+           f"content-desc=\"\" clickable=\"false\" focusable=\"false\" bounds=\"[0,0][{width},{height}]\">"
+
+
+def deep_hierarchy(nodes, depth, rng):
+    # Chains of nested nodes under one root, each as deep as the depth argument
+    out = [root_node()]
+    count = 1
+    while count < nodes:
+        chain = min(depth, nodes - count)
+        out.extend(node(rng, 0) for _ in range(chain))
+        out.append("</node>" * chain)
+        count += chain
+    out.append("</node></hierarchy>")
+    return "".join(out)
+
+
+def wide_hierarchy(nodes, rng):
+    # A flat list of rows with two children each, like a long feed
+    out = [root_node()]
+    count = 1
+    while count < nodes:
+        out.append(node(rng, count))
+        out.append(node(rng, 0) + "</node>" + node(rng, 1) + "</node>")
+        out.append("</node>")
+        count += 3
+    out.append("</node></hierarchy>")
+    return "".join(out)
+
+
+# The extraction as it was before subtrees were freed, with the same single pass and de-duplication. iterparse keeps
+# building the tree, so all of it stays alive until the walk is done.
+def reference_extract(xml_path, attribs=("clickable", "focusable")):
+    elem_lists = {attrib: ElementColumns() for attrib in attribs}
+    grids = {attrib: CenterGrid(configs["MIN_DIST"]) for attrib in attribs}
+    path = []
+    for event, elem in ET.iterparse(xml_path, ['start', 'end']):
+        if event == 'start':
+            path.append(elem)
+            matched = [attrib for attrib in attribs if elem.attrib.get(attrib) == "true"]
+            if not matched:
+                continue
+            elem_id = get_id_from_element(elem)
+            if len(path) > 1:
+                elem_id = get_id_from_element(path[-2]) + "_" + elem_id
+            elem_id += f"_{elem.attrib['index']}"
+            bounds = elem.attrib["bounds"][1:-1].split("][")
+            x1, y1 = map(int, bounds[0].split(","))
+            x2, y2 = map(int, bounds[1].split(","))
+            center = (x1 + x2) // 2, (y1 + y2) // 2
+            for attrib in matched:
+                if not grids[attrib].is_close(center):
+                    grids[attrib].add(center)
+                    elem_lists[attrib].append(elem_id, (x1, y1, x2, y2), center)
+        if event == 'end':
+            path.pop()
+    return merge_elements(elem_lists)
+
+
+def peak_memory(run):
+    tracemalloc.start()
+    result = run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+
+def run_time(run, runs=3):
+    # Timed separately, tracemalloc slows every allocation down
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def rows(elem_list):
+    return [(elem.uid, elem.bbox, elem.attrib) for elem in elem_list]
+
+
+rng = random.Random(args["seed"])
+for shape in ("deep", "wide"):
+    for size in map(int, args["sizes"].split(",")):
+        if shape == "deep":
+            xml = deep_hierarchy(size, args["depth"], rng)
+        else:
+            xml = wide_hierarchy(size, rng)
+        fd, xml_path = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "w") as f:
+            f.write(xml)
+        expected, reference_peak = peak_memory(lambda: reference_extract(xml_path))
+        elem_list, peak = peak_memory(lambda: extract_elements(xml_path, add_index=True))
+        if rows(elem_list) != rows(expected):
+            print_with_color(f"ERROR: the {shape} hierarchy of {size} nodes gives different elements than the "
+                             f"reference", "red")
+            raise SystemExit(1)
+        reference_time = run_time(lambda: reference_extract(xml_path))
+        elapsed = run_time(lambda: extract_elements(xml_path, add_index=True))
+        os.remove(xml_path)
+        print_with_color(f"{shape} {size} nodes, {len(xml) / 1e6:.1f} MB, {len(elem_list)} elements: whole tree "
+                         f"{reference_peak / 1e6:.1f} MB peak in {reference_time:.2f} s, freed subtrees "
+                         f"{peak / 1e6:.1f} MB peak in {elapsed:.2f} s ({(elapsed / reference_time - 1) * 100:+.0f}% "
+                         f"time)", "cyan")
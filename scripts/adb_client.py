@@ -0,0 +1,293 @@
+import os
+import queue
+import signal
+import socket
+import struct
+import threading
+import uuid
+
+from utils import print_with_color
+
+
+class AdbProtocolError(Exception):
+    pass
+
+
+# Every adb call that is in flight registers how to abort it, so that all of them can be cancelled at once, e.g. when
+# the user stops the exploration. Whether the last call of the current thread timed out is kept per thread, so that
+# callers can tell a timeout apart from an ordinary failure without changing the "ERROR" return convention.
+active_calls = {}
+active_calls_lock = threading.Lock()
+call_state = threading.local()
+
+
+def register_call(cancel):
+    token = object()
+    with active_calls_lock:
+        active_calls[token] = cancel
+    return token
+
+
+def unregister_call(token):
+    with active_calls_lock:
+        active_calls.pop(token, None)
+
+
+def cancel_all():
+    with active_calls_lock:
+        cancels = list(active_calls.values())
+        active_calls.clear()
+    for cancel in cancels:
+        try:
+            cancel()
+        except OSError:
+            pass
+    return len(cancels)
+
+
+def set_timed_out(timed_out):
+    call_state.timed_out = timed_out
+
+
+def last_call_timed_out():
+    return getattr(call_state, "timed_out", False)
+
+
+def kill_process_tree(proc):
+    # Each adb call runs in its own process group, kill the whole group so that nothing it started is left behind,
+    # e.g. the adb client below the local shell of a string command
+    if proc.poll() is not None:
+        return
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+
+def shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbProtocolError("connection closed by the adb server")
+        data += chunk
+    return bytes(data)
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(64 * 1024)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def send_request(sock, request):
+    # Host requests are framed as four hex digits of length followed by the payload, and answered by OKAY or FAIL
+    payload = request.encode()
+    sock.sendall(b"%04x" % len(payload) + payload)
+    status = recv_exactly(sock, 4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        length = int(recv_exactly(sock, 4), 16)
+        raise AdbProtocolError(recv_exactly(sock, length).decode(errors="replace"))
+    raise AdbProtocolError(f"unexpected response {status!r} to {request}")
+
+
+class SocketStream:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rb")
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def read1(self, size=-1):
+        return self.file.read1(size)
+
+    def close(self):
+        # Closing alone does not wake up a read that is blocked in another thread, shutting the socket down does
+        shutdown_socket(self.sock)
+        self.file.close()
+        self.sock.close()
+
+
+class AdbClient:
+    # Talks to the adb server directly instead of spawning the adb binary for every command. Connections that have
+    # already been switched to the device are kept warm in a pool, and one sync connection is reused for all pulls.
+    def __init__(self, device, host="127.0.0.1", port=5037, pool_size=2, timeout=30):
+        self.device = device
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.sync_sock = None
+        self.sync_lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_request(sock, f"host:transport:{self.device}")
+        except (OSError, AdbProtocolError):
+            sock.close()
+            raise
+        return sock
+
+    def warm(self):
+        try:
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(self.connect())
+        except (OSError, AdbProtocolError):
+            pass
+
+    def open_service(self, service, timeout=None):
+        # Each service consumes its connection, so take a warm one and start warming its replacement right away.
+        # A pooled connection may have gone stale, in which case a fresh one is tried once.
+        try:
+            sock = self.pool.get_nowait()
+        except queue.Empty:
+            sock = None
+        threading.Thread(target=self.warm, daemon=True).start()
+        if sock is not None:
+            try:
+                sock.settimeout(timeout or self.timeout)
+                send_request(sock, service)
+                return sock
+            except (OSError, AdbProtocolError):
+                sock.close()
+        sock = self.connect()
+        try:
+            sock.settimeout(timeout or self.timeout)
+            send_request(sock, service)
+        except (OSError, AdbProtocolError):
+            sock.close()
+            raise
+        return sock
+
+    def call(self, service, timeout, read):
+        set_timed_out(False)
+        try:
+            sock = self.open_service(service, timeout)
+            token = register_call(lambda: shutdown_socket(sock))
+            try:
+                return read(sock)
+            finally:
+                unregister_call(token)
+                sock.close()
+        except socket.timeout:
+            set_timed_out(True)
+            raise
+
+    def exec_out(self, command, timeout=None):
+        try:
+            return self.call(f"exec:{command}", timeout, recv_all)
+        except (OSError, AdbProtocolError) as e:
+            print_with_color(f"Command execution failed: exec:{command}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+
+    def open_stream(self, command, timeout=None):
+        # Returns a binary file object over the output of the command, to be read while it is still running.
+        # The timeout applies to each read, a timeout of 0 lets the reads block for commands that run until closed.
+        try:
+            sock = self.open_service(f"exec:{command}", timeout)
+        except (OSError, AdbProtocolError) as e:
+            print_with_color(f"Command execution failed: exec:{command}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+        if timeout == 0:
+            sock.settimeout(None)
+        return SocketStream(sock)
+
+    def shell(self, command, timeout=None):
+        # The legacy shell service does not report exit codes, so the command echoes its own after a marker line
+        marker = f"__APPAGENT_{uuid.uuid4().hex}__"
+        try:
+            output = self.call(f"shell:{command} 2>&1; __rc=$?; echo; echo \"{marker} $__rc\"", timeout, recv_all)
+            output = output.decode(errors="replace").replace("\r\n", "\n")
+        except (OSError, AdbProtocolError) as e:
+            print_with_color(f"Command execution failed: {command}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+        output, _, returncode = output.rpartition(marker)
+        if returncode.strip() == "0":
+            return output.strip()
+        print_with_color(f"Command execution failed: {command}", "red")
+        print_with_color(output, "red")
+        return "ERROR"
+
+    def pull(self, remote_path, local_path, timeout=None):
+        set_timed_out(False)
+        with self.sync_lock:
+            for attempt in range(2):
+                token = None
+                try:
+                    if self.sync_sock is None:
+                        self.sync_sock = self.open_service("sync:")
+                    sync_sock = self.sync_sock
+                    token = register_call(lambda: shutdown_socket(sync_sock))
+                    sync_sock.settimeout(timeout or self.timeout)
+                    data = self.sync_recv(remote_path)
+                    break
+                except (OSError, AdbProtocolError) as e:
+                    if self.sync_sock is not None:
+                        self.sync_sock.close()
+                        self.sync_sock = None
+                    if isinstance(e, socket.timeout):
+                        set_timed_out(True)
+                    if attempt == 1 or isinstance(e, (FileNotFoundError, socket.timeout)):
+                        print_with_color(f"Command execution failed: pull {remote_path}", "red")
+                        print_with_color(str(e), "red")
+                        return "ERROR"
+                finally:
+                    if token is not None:
+                        unregister_call(token)
+        with open(local_path, "wb") as f:
+            f.write(data)
+        return local_path
+
+    def sync_recv(self, remote_path):
+        path = remote_path.encode()
+        self.sync_sock.sendall(b"RECV" + struct.pack("<I", len(path)) + path)
+        chunks = []
+        while True:
+            header = recv_exactly(self.sync_sock, 8)
+            sync_id, length = header[:4], struct.unpack("<I", header[4:])[0]
+            if sync_id == b"DATA":
+                chunks.append(recv_exactly(self.sync_sock, length))
+            elif sync_id == b"DONE":
+                return b"".join(chunks)
+            elif sync_id == b"FAIL":
+                message = recv_exactly(self.sync_sock, length).decode(errors="replace")
+                raise FileNotFoundError(f"{remote_path}: {message}")
+            else:
+                raise AdbProtocolError(f"unexpected sync response {sync_id!r}")
+
+    def close(self):
+        with self.sync_lock:
+            if self.sync_sock is not None:
+                try:
+                    self.sync_sock.sendall(b"QUIT" + struct.pack("<I", 0))
+                except OSError:
+                    pass
+                self.sync_sock.close()
+                self.sync_sock = None
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
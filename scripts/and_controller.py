@@ -1,31 +1,244 @@
+import base64
+import hashlib
+import io
 import os
+import re
+import shlex
 import shutil
+import socket
 import subprocess
+import sys
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 
 from config import load_config
-from utils import print_with_color
+from device_profile import PROBE_COMMAND, FINGERPRINT_COMMAND, parse_profile, load_profile, save_profile, \
+    screen_size
+from adb_client import AdbClient, register_call, unregister_call, set_timed_out, last_call_timed_out, \
+    kill_process_tree
+from hierarchy_service import HierarchyService
+from frame_stream import FrameStream
+from utils import print_with_color, Frame, read_image, frame_signature, wait_until_stable, artifacts, \
+    raw_format_supported
 
 
 configs = load_config()
 
 
 class AndroidElement:
+    __slots__ = ("uid", "bbox", "attrib")
+
     def __init__(self, uid, bbox, attrib):
         self.uid = uid
         self.bbox = bbox
         self.attrib = attrib
 
 
-def execute_adb(adb_command):
+class ElementColumns:
+    # The elements found for one attribute during a walk, kept as parallel columns so that the table of the screen is
+    # assembled from them without an object per element
+    __slots__ = ("uids", "boxes", "centers")
+
+    def __init__(self):
+        self.uids = []
+        self.boxes = []
+        self.centers = []
+
+    def __len__(self):
+        return len(self.uids)
+
+    def append(self, uid, box, center):
+        self.uids.append(sys.intern(uid))
+        self.boxes.append(box)
+        self.centers.append(center)
+
+
+class ElementTable:
+    # Columnar storage of the elements of one screen. Rows are x1, y1, x2, y2 of the bounding boxes, the attributes are
+    # stored as indices into attrib_names and the uids are interned.
+    def __init__(self, uids, boxes, attribs, attrib_names):
+        self.uids = uids
+        self.boxes = boxes
+        self.centers = (boxes[:, :2] + boxes[:, 2:]) // 2
+        self.attribs = attribs
+        self.attrib_names = attrib_names
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, i):
+        # Builds an element for code that expects one, the agent itself reads the columns
+        x1, y1, x2, y2 = self.boxes[i].tolist()
+        return AndroidElement(self.uids[i], ((x1, y1), (x2, y2)), self.attrib_names[self.attribs[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def center(self, i):
+        x, y = self.centers[i].tolist()
+        return x, y
+
+    def bbox(self, i):
+        x1, y1, x2, y2 = self.boxes[i].tolist()
+        return (x1, y1), (x2, y2)
+
+    def areas(self):
+        return (self.boxes[:, 2] - self.boxes[:, 0]) * (self.boxes[:, 3] - self.boxes[:, 1])
+
+    def hit_test(self, x, y):
+        # Indices of all elements whose bounding box contains the point, smallest element first
+        boxes = self.boxes
+        inside = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+        indices = np.flatnonzero(inside)
+        return indices[np.argsort(self.areas()[indices], kind="stable")].tolist()
+
+    def with_attrib(self, attrib):
+        if attrib not in self.attrib_names:
+            return np.zeros(len(self), dtype=bool)
+        return self.attribs == self.attrib_names.index(attrib)
+
+
+def format_command(adb_command):
+    return adb_command if isinstance(adb_command, str) else " ".join(adb_command)
+
+
+def run_adb(adb_command, timeout=None, text=True):
+    # The command gets its own process group so that a timeout or a cancellation takes down adb along with its shell
+    # A list is run without a local shell, so that compound commands reach the device shell in one piece
+    set_timed_out(False)
+    proc = subprocess.Popen(adb_command, shell=isinstance(adb_command, str), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=text, start_new_session=True)
+    token = register_call(lambda: kill_process_tree(proc))
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(proc)
+        proc.communicate()
+        set_timed_out(True)
+        print_with_color(f"Command timed out after {timeout} seconds: {format_command(adb_command)}", "red")
+        return None
+    finally:
+        unregister_call(token)
+    return proc.returncode, stdout, stderr
+
+
+def execute_adb(adb_command, timeout=None):
     # print(adb_command)
-    result = subprocess.run(adb_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode == 0:
-        return result.stdout.strip()
-    print_with_color(f"Command execution failed: {adb_command}", "red")
-    print_with_color(result.stderr, "red")
+    result = run_adb(adb_command, timeout)
+    if result is None:
+        return "ERROR"
+    returncode, stdout, stderr = result
+    if returncode == 0:
+        return stdout.strip()
+    print_with_color(f"Command execution failed: {format_command(adb_command)}", "red")
+    print_with_color(stderr, "red")
+    return "ERROR"
+
+
+class AdbShellSession:
+    def __init__(self, device):
+        self.device = device
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.proc = subprocess.Popen(["adb", "-s", self.device, "shell"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                                     start_new_session=True)
+
+    def close(self):
+        # Wait for a command that is still running in another thread instead of writing into the middle of it
+        with self.lock:
+            if self.proc is None:
+                return
+            try:
+                self.proc.stdin.write("exit\n")
+                self.proc.stdin.flush()
+                self.proc.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+            self.proc = None
+
+    def execute(self, command, timeout=None):
+        # The shell reads the commands from the same pipe as the sentinel below. A command with an unbalanced quote
+        # would swallow the sentinel as part of its argument and leave the shell waiting until the timeout.
+        try:
+            shlex.split(command)
+        except ValueError as e:
+            print_with_color(f"Command execution failed: {command}", "red")
+            print_with_color(f"not a complete shell command: {e}", "red")
+            return "ERROR"
+        with self.lock:
+            set_timed_out(False)
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            # A command that does not come back in time takes the whole session down with it, which ends the read
+            # below. The next command starts a new session.
+            proc = self.proc
+            expired = threading.Event()
+
+            def expire():
+                expired.set()
+                kill_process_tree(proc)
+
+            timer = threading.Timer(timeout, expire) if timeout else None
+            token = register_call(lambda: kill_process_tree(proc))
+            if timer:
+                timer.start()
+            # The sentinel carries the exit code of the command so that a single long-lived shell can tell where
+            # each command's output ends and whether it succeeded. The command is grouped so that stdin and stderr are
+            # redirected for all of it, a command that reads stdin would otherwise read the sentinel line.
+            marker = f"__APPAGENT_{uuid.uuid4().hex}__"
+            try:
+                self.proc.stdin.write(f"{{ {command}\n}} </dev/null 2>&1\n__rc=$?; echo; echo \"{marker} $__rc\"\n")
+                self.proc.stdin.flush()
+                lines = []
+                while True:
+                    line = self.proc.stdout.readline()
+                    if not line:
+                        raise OSError("adb shell session terminated")
+                    line = line.rstrip("\r\n")
+                    if line.startswith(marker):
+                        returncode = int(line[len(marker):].strip())
+                        break
+                    lines.append(line)
+            except (OSError, ValueError) as e:
+                if expired.is_set():
+                    set_timed_out(True)
+                    e = f"timed out after {timeout} seconds"
+                print_with_color(f"Command execution failed: {command}", "red")
+                print_with_color(str(e), "red")
+                self.proc.kill()
+                self.proc = None
+                return "ERROR"
+            finally:
+                if timer:
+                    timer.cancel()
+                unregister_call(token)
+        output = "\n".join(lines)
+        if returncode == 0:
+            return output.strip()
+        print_with_color(f"Command execution failed: {command}", "red")
+        print_with_color(output, "red")
+        return "ERROR"
+
+
+def execute_adb_bytes(adb_command, timeout=None):
+    result = run_adb(adb_command, timeout, text=False)
+    if result is None:
+        return "ERROR"
+    returncode, stdout, stderr = result
+    if returncode == 0:
+        return stdout
+    print_with_color(f"Command execution failed: {format_command(adb_command)}", "red")
+    print_with_color(stderr.decode(errors="replace"), "red")
     return "ERROR"
 
 
@@ -56,106 +269,936 @@ def get_id_from_element(elem):
     return elem_id
 
 
-def traverse_tree(xml_path, elem_list, attrib, add_index=False):
+def iter_stream_events(stream, chunk_size=16 * 1024):
+    # "uiautomator dump /dev/tty" prints a status line right after the closing root tag, so parsing stops at the first
+    # error once the root element has been closed instead of failing the whole dump.
+    parser = ET.XMLPullParser(["start", "end"])
+    depth = 0
+    root_closed = False
+    while not root_closed:
+        data = stream.read(chunk_size)
+        if not data:
+            parser.close()
+            return
+        parser.feed(data)
+        events = parser.read_events()
+        while True:
+            try:
+                event, elem = next(events)
+            except StopIteration:
+                break
+            except ET.ParseError:
+                if root_closed:
+                    return
+                raise
+            depth += 1 if event == "start" else -1
+            root_closed = depth == 0
+            yield event, elem
+
+
+def walk_tree(events, elem_lists, add_index=False, nodes=None):
+    # Each entry of the path is [element, element id, node key] for one open ancestor. The id is computed on first use
+    # and then shared by the element itself and all of its children. When a nodes dict is given, every node of the
+    # hierarchy is recorded in it under its structural key so that consecutive dumps can be diffed.
+    grids = {attrib: CenterGrid(configs["MIN_DIST"], columns.centers) for attrib, columns in elem_lists.items()}
     path = []
-    for event, elem in ET.iterparse(xml_path, ['start', 'end']):
+    for event, elem in events:
         if event == 'start':
-            path.append(elem)
-            if attrib in elem.attrib and elem.attrib[attrib] == "true":
-                parent_prefix = ""
-                if len(path) > 1:
-                    parent_prefix = get_id_from_element(path[-2])
-                bounds = elem.attrib["bounds"][1:-1].split("][")
-                x1, y1 = map(int, bounds[0].split(","))
-                x2, y2 = map(int, bounds[1].split(","))
-                center = (x1 + x2) // 2, (y1 + y2) // 2
-                elem_id = get_id_from_element(elem)
-                if parent_prefix:
-                    elem_id = parent_prefix + "_" + elem_id
-                if add_index:
-                    elem_id += f"_{elem.attrib['index']}"
-                close = False
-                for e in elem_list:
-                    bbox = e.bbox
-                    center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-                    dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-                    if dist <= configs["MIN_DIST"]:
-                        close = True
-                        break
-                if not close:
-                    elem_list.append(AndroidElement(elem_id, ((x1, y1), (x2, y2)), attrib))
+            node_key = None
+            if nodes is not None:
+                node_key = f"{path[-1][2] if path else ''}/{elem.attrib.get('class', elem.tag)}" \
+                           f"[{elem.attrib.get('index', '')}]"
+                nodes[node_key] = tuple(elem.attrib.get(name, "") for name in NODE_STATE_ATTRIBS)
+            path.append([elem, None, node_key])
+            matched = [attrib for attrib in elem_lists if elem.attrib.get(attrib) == "true"]
+            if not matched:
+                continue
+            parent_prefix = ""
+            if len(path) > 1:
+                if path[-2][1] is None:
+                    path[-2][1] = get_id_from_element(path[-2][0])
+                parent_prefix = path[-2][1]
+            bounds = elem.attrib["bounds"][1:-1].split("][")
+            x1, y1 = map(int, bounds[0].split(","))
+            x2, y2 = map(int, bounds[1].split(","))
+            center = (x1 + x2) // 2, (y1 + y2) // 2
+            path[-1][1] = get_id_from_element(elem)
+            elem_id = path[-1][1]
+            if parent_prefix:
+                elem_id = parent_prefix + "_" + elem_id
+            if add_index:
+                elem_id += f"_{elem.attrib['index']}"
+            for attrib in matched:
+                if not grids[attrib].is_close(center):
+                    grids[attrib].add(center)
+                    elem_lists[attrib].append(elem_id, (x1, y1, x2, y2), center)
 
         if event == 'end':
             path.pop()
+            # Everything needed from a finished subtree has been extracted, so free it and detach it from its parent.
+            # Only the open ancestors stay alive, which keeps memory flat however large the dump is.
+            elem.clear()
+            if path:
+                path[-1][0].remove(elem)
+
+
+# The first attribute decides whether a node moved, the others whether it was updated in place. The attributes that
+# decide whether a node becomes an element and what its uid is are compared too, so that an empty diff means the
+# elements and their numeric tags are the same as in the previous round.
+NODE_STATE_ATTRIBS = ("bounds", "text", "content-desc", "checked", "selected", "focused", "enabled", "clickable",
+                      "focusable", "long-clickable", "scrollable", "resource-id")
+
+
+class TreeDiff:
+    def __init__(self, added, removed, moved, updated):
+        self.added = added
+        self.removed = removed
+        self.moved = moved
+        self.updated = updated
+
+    @property
+    def changed(self):
+        return bool(self.added or self.removed or self.moved or self.updated)
+
+    def to_dict(self, limit=None):
+        return {name: {"count": len(keys), "nodes": keys[:limit]}
+                for name, keys in (("added", self.added), ("removed", self.removed), ("moved", self.moved),
+                                   ("updated", self.updated))}
+
+    def summary(self):
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.moved)} moved, " \
+               f"{len(self.updated)} updated"
+
+
+def diff_nodes(previous, nodes):
+    added = [key for key in nodes if key not in previous]
+    removed = [key for key in previous if key not in nodes]
+    moved = []
+    updated = []
+    for key, state in nodes.items():
+        state_ = previous.get(key)
+        if state_ is None or state_ == state:
+            continue
+        if state_[0] != state[0]:
+            moved.append(key)
+        else:
+            updated.append(key)
+    return TreeDiff(added, removed, moved, updated)
+
+
+class HierarchyDiffer:
+    # Keeps the nodes of the previous dump and reports what changed structurally in the next one
+    def __init__(self):
+        self.nodes = {}
+
+    def update(self, nodes):
+        diff = diff_nodes(self.nodes, nodes)
+        self.nodes = nodes
+        return diff
+
+
+def elem_center(elem):
+    bbox = elem.bbox
+    return (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
+
+
+class CenterGrid:
+    # Uniform grid of element centres with cells as wide as the minimum distance, so any centre within that distance
+    # of a point lies in the point's cell or one of its eight neighbours.
+    def __init__(self, min_dist, centers=()):
+        self.min_dist = min_dist
+        self.cell_size = max(min_dist, 1)
+        self.cells = {}
+        for center in centers:
+            self.add(center)
+
+    def cell(self, center):
+        return int(center[0] // self.cell_size), int(center[1] // self.cell_size)
+
+    def add(self, center):
+        self.cells.setdefault(self.cell(center), []).append(center)
+
+    def is_close(self, center):
+        cx, cy = self.cell(center)
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for center_ in self.cells.get((i, j), ()):
+                    dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
+                    if dist <= self.min_dist:
+                        return True
+        return False
+
+
+def traverse_tree(xml_path, elem_list, attrib, add_index=False):
+    # Appends AndroidElement objects to a plain list, the elements already in it shadow the ones close to them
+    columns = ElementColumns()
+    for elem in elem_list:
+        columns.append(elem.uid, elem.bbox[0] + elem.bbox[1], elem_center(elem))
+    known = len(columns)
+    walk_tree(ET.iterparse(xml_path, ['start', 'end']), {attrib: columns}, add_index)
+    for uid, (x1, y1, x2, y2) in zip(columns.uids[known:], columns.boxes[known:]):
+        elem_list.append(AndroidElement(uid, ((x1, y1), (x2, y2)), attrib))
+
+
+def merge_elements(elem_lists, skip_uids=()):
+    # elem_lists maps each attribute to its ElementColumns. Elements of later attributes are only kept if they are not
+    # too close to any element of the earlier ones. Skipped elements are left out of the table but still shadow the
+    # elements close to them.
+    uids, boxes, codes = [], [], []
+    seen = CenterGrid(configs["MIN_DIST"])
+    for code, columns in enumerate(elem_lists.values()):
+        for uid, box, center in zip(columns.uids, columns.boxes, columns.centers):
+            if uid not in skip_uids and not seen.is_close(center):
+                uids.append(uid)
+                boxes.append(box)
+                codes.append(code)
+        for center in columns.centers:
+            seen.add(center)
+    return ElementTable(uids, np.array(boxes, dtype=np.int32).reshape(-1, 4), np.array(codes, dtype=np.uint8),
+                        list(elem_lists))
+
+
+def extract_elements(xml_source, attribs=("clickable", "focusable"), add_index=False, skip_uids=(), nodes=None):
+    # xml_source is either the path of a dump or a binary stream that is still being written to
+    if isinstance(xml_source, str):
+        events = ET.iterparse(xml_source, ['start', 'end'])
+    else:
+        events = iter_stream_events(xml_source)
+    elem_lists = {attrib: ElementColumns() for attrib in attribs}
+    walk_tree(events, elem_lists, add_index, nodes)
+    return merge_elements(elem_lists, skip_uids)
+
+
+class StreamRecorder:
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.chunks.append(data)
+        return data
+
+    def save(self, path):
+        data = b"".join(self.chunks)
+        end = data.rfind(b"</hierarchy>")
+        if end >= 0:
+            data = data[:end + len(b"</hierarchy>")]
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+class ProcessStream:
+    def __init__(self, proc, timeout=None):
+        self.proc = proc
+        self.timed_out = False
+        self.token = register_call(lambda: kill_process_tree(proc))
+        self.timer = threading.Timer(timeout, self.expire) if timeout else None
+        if self.timer:
+            self.timer.start()
+
+    def expire(self):
+        self.timed_out = True
+        kill_process_tree(self.proc)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def read1(self, size=-1):
+        return self.proc.stdout.read1(size)
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+        unregister_call(self.token)
+        kill_process_tree(self.proc)
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+class ScreenState:
+    def __init__(self, frame, elem_list, nodes, started, screenshot_time, xml_time, xml_path=None, screen_key=None,
+                 skip_uids=frozenset(), reused=False, input_count=0):
+        self.frame = frame
+        self.elem_list = elem_list
+        self.nodes = nodes
+        self.started = started
+        self.screenshot_time = screenshot_time
+        self.xml_time = xml_time
+        self.xml_path = xml_path
+        self.screen_key = screen_key
+        self.skip_uids = skip_uids
+        self.reused = reused
+        # The number of inputs the controller had sent when the capture started
+        self.input_count = input_count
+        self._signature = None
+
+    @property
+    def signature(self):
+        if self._signature is None and self.frame != "ERROR":
+            self._signature = frame_signature(self.frame)
+        return self._signature
+
+    @property
+    def ok(self):
+        return self.frame != "ERROR" and self.elem_list != "ERROR"
+
+    @property
+    def latency(self):
+        return max(self.screenshot_time, self.xml_time) - self.started
+
 
 def append_to_log(text: str, log_file: str, break_line: bool = True):
-    with open(log_file, "a") as f:
-        f.write(text + ("\n" if break_line else ""))
+    artifacts.append(log_file, text + ("\n" if break_line else ""))
+
+
+ADB_KEYBOARD_IME = "com.android.adbkeyboard/.AdbIME"
+
+
+SCREEN_KEY_PATTERN = re.compile(r"(mCurrentFocus|mFocusedApp|mResumedActivity|topResumedActivity)[=:]\s*\S*?\{([^}]*)\}")
+
+
+def parse_screen_key(text):
+    # "mFocusedApp=ActivityRecord{8f3a u0 com.example/.MainActivity t42}" gives com.example/.MainActivity, and the
+    # focused window adds popups and dialogs that do not change the activity
+    parts = {}
+    for name, body in SCREEN_KEY_PATTERN.findall(text):
+        tokens = [token for token in body.split() if not re.fullmatch(r"[0-9a-f]+|u\d+|t\d+", token)]
+        if tokens:
+            parts.setdefault(name, tokens[-1])
+    if not parts:
+        return None
+    return "|".join(parts[name] for name in sorted(parts))
+
+
+SETTLE_SIGNALS = ("frame", "focus", "xml")
+
+
+def command_kind(command):
+    if command.startswith("input ") or command.startswith("am broadcast"):
+        return "input"
+    if "uiautomator" in command:
+        return "dump"
+    if "screencap" in command:
+        return "capture"
+    return "default"
+
+
+class AdbMonitor:
+    # Counts calls, timeouts and retries per kind of command for one device, and recycles the connection to the
+    # device once too many calls in a row have timed out
+    def __init__(self, device, max_timeouts, recycle):
+        self.device = device
+        self.max_timeouts = max_timeouts
+        self.recycle = recycle
+        self.counters = {}
+        self.consecutive_timeouts = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind, name):
+        with self.lock:
+            counters = self.counters.setdefault(kind, {})
+            counters[name] = counters.get(name, 0) + 1
+
+    def record(self, kind, timed_out, retry=False):
+        self.count(kind, "calls")
+        if retry:
+            self.count(kind, "retries")
+        if not timed_out:
+            with self.lock:
+                self.consecutive_timeouts = 0
+            return
+        self.count(kind, "timeouts")
+        with self.lock:
+            self.consecutive_timeouts += 1
+            wedged = self.consecutive_timeouts >= self.max_timeouts
+            if wedged:
+                self.consecutive_timeouts = 0
+        if wedged:
+            self.count("device", "recycles")
+            print_with_color(f"{self.device} stopped responding, recycling the adb connection", "yellow")
+            self.recycle()
+
+    def snapshot(self):
+        with self.lock:
+            return {kind: dict(counters) for kind, counters in self.counters.items()}
+
+    def summary(self):
+        return ", ".join(f"{kind}: " + " ".join(f"{name}={value}" for name, value in counters.items())
+                         for kind, counters in self.snapshot().items())
+
+
+def escape_input_text(input_str):
+    input_str = input_str.replace(" ", "%s")
+    input_str = input_str.replace("'", "")
+    return input_str
+
+
+# Builders of the input commands, shared by the single actions of the controller and by action batches
+def input_tap(x, y):
+    return f"input tap {x} {y}"
+
+
+def input_swipe(start_x, start_y, end_x, end_y, duration):
+    return f"input swipe {start_x} {start_y} {end_x} {end_y} {duration}"
+
+
+def input_keyevent(*keycodes):
+    return "input keyevent " + " ".join(keycodes)
+
+
+def input_text(input_str):
+    return f"input text {escape_input_text(input_str)}"
+
+
+class ActionBatch:
+    # Queues several input actions and sends them to the device as a single shell script, so a composite interaction
+    # pays for one adb round trip. The device still starts one input process per command of the script: every tap or
+    # swipe is its own input call, and typing then submitting is two (input text, then input keyevent). Only
+    # consecutive key events, or consecutive text inputs, are merged into one input invocation.
+    def __init__(self, controller):
+        self.controller = controller
+        self.actions = []
+        self.wait_time = 0
+        self.error = False
+
+    def tap(self, x, y):
+        self.actions.append(("command", input_tap(x, y)))
+        return self
+
+    def long_press(self, x, y, duration=1000):
+        self.actions.append(("command", input_swipe(x, y, x, y, duration)))
+        return self
+
+    def swipe(self, x, y, direction, dist="medium", quick=False):
+        command = self.controller.swipe_command(x, y, direction, dist, quick)
+        if command is None:
+            self.error = True
+            return self
+        self.actions.append(("command", command))
+        return self
+
+    def swipe_precise(self, start, end, duration=400):
+        self.actions.append(("command", input_swipe(*start, *end, duration)))
+        return self
+
+    def text(self, input_str):
+        self.actions.append(("text", input_str))
+        return self
+
+    def keyevent(self, keycode):
+        self.actions.append(("keyevent", [str(keycode)]))
+        return self
+
+    def back(self):
+        return self.keyevent("KEYCODE_BACK")
+
+    def enter(self):
+        return self.keyevent("KEYCODE_ENTER")
+
+    def wait(self, seconds):
+        self.actions.append(("command", f"sleep {seconds}"))
+        self.wait_time += seconds
+        return self
+
+    def commands(self):
+        merged = []
+        for kind, value in self.actions:
+            if merged and merged[-1][0] == kind == "keyevent":
+                merged[-1][1] += value
+            elif merged and merged[-1][0] == kind == "text":
+                merged[-1][1] += value
+            else:
+                merged.append([kind, value])
+        commands = []
+        for kind, value in merged:
+            if kind == "keyevent":
+                commands.append(input_keyevent(*value))
+            elif kind == "text":
+                commands.append(self.controller.text_command(value))
+            else:
+                commands.append(value)
+        return commands
+
+    def script(self):
+        return " && ".join(self.commands())
+
+    def run(self):
+        if self.error:
+            return "ERROR"
+        if not self.actions:
+            return ""
+        # Every input of the script gets the time it would have had on its own, on top of the queued waits
+        commands = self.commands()
+        inputs = sum(not command.startswith("sleep ") for command in commands)
+        timeout = self.controller.timeouts["input"] * max(inputs, 1) + self.wait_time
+        ret = self.controller.shell(" && ".join(commands), "input", timeout)
+        self.actions = []
+        self.wait_time = 0
+        return ret
+
 
 class AndroidController:
     def __init__(self, device):
         self.device = device
         self.screenshot_dir = configs["ANDROID_SCREENSHOT_DIR"]
         self.xml_dir = configs["ANDROID_XML_DIR"]
-        self.width, self.height = self.get_device_size()
+        self.screenshot_format = configs["SCREENSHOT_FORMAT"]
+        # Cleared once the device sends a raw pixel format that cannot be wrapped, both the screenshots and the settle
+        # samples go straight to PNG from then on
+        self.raw_supported = True
+        self.xml_stream = configs["XML_STREAM"]
+        self.settle_signals = list(configs["SETTLE_SIGNALS"])
+        self.settle_failures = {}
+        self.session = AdbShellSession(device) if configs["ADB_SESSION"] else None
+        self.text_input_mode = configs["TEXT_INPUT_MODE"]
+        self.fast_text = None
+        self.fast_text_time = 0
+        self.adb = None
+        if configs["ADB_TRANSPORT"] == "socket":
+            self.adb = AdbClient(device, configs["ADB_SERVER_HOST"], configs["ADB_SERVER_PORT"])
+        self.xml_backend = configs["XML_BACKEND"]
+        self.screen_key = None
+        self.screen_key_time = 0
+        self.input_count = 0
+        self.hierarchy_service = None
+        self.forward_port = None
+        self.timeouts = {"capture": configs["ADB_TIMEOUT_CAPTURE"], "input": configs["ADB_TIMEOUT_INPUT"],
+                         "dump": configs["ADB_TIMEOUT_DUMP"], "default": configs["ADB_TIMEOUT_DEFAULT"]}
+        self.retries = configs["ADB_RETRIES"]
+        self.monitor = AdbMonitor(device, configs["ADB_WATCHDOG_TIMEOUTS"], self.recycle)
         self.backslash = "\\"
+        # Runs the screenshot or the screen key probe of a capture next to it, and the profile check at startup
+        self.capture_pool = ThreadPoolExecutor(max_workers=2)
+        self.profile_path = os.path.expanduser(configs["DEVICE_PROFILE_CACHE"])
+        self.profile = load_profile(self.profile_path, device)
+        if self.profile:
+            # Start right away with the cached profile and make sure in the background that the device was not
+            # flashed with another build in the meantime
+            self.width, self.height = screen_size(self.profile)
+            self.capture_pool.submit(self.validate_profile)
+        else:
+            self.width, self.height = 0, 0
+            self.refresh_profile()
+        self.frame_stream = None
+        if configs["FRAME_STREAM"]:
+            self.start_frame_stream()
+
+    def call(self, kind, run, timeout=None):
+        # Only captures and dumps are retried after a timeout, repeating an input could act twice
+        retries = self.retries if kind in ("capture", "dump") else 0
+        timeout = self.timeouts[kind] if timeout is None else timeout
+        for attempt in range(retries + 1):
+            ret = run(timeout)
+            timed_out = last_call_timed_out()
+            self.monitor.record(kind, timed_out, attempt > 0)
+            if not timed_out:
+                break
+        return ret
+
+    def shell(self, command, kind=None, timeout=None):
+        kind = kind or command_kind(command)
+        if kind == "input":
+            # Any input may move to another screen
+            self.screen_key = None
+            self.input_count += 1
+        if self.adb:
+            return self.call(kind, lambda timeout: self.adb.shell(command, timeout), timeout)
+        if self.session:
+            return self.call(kind, lambda timeout: self.session.execute(command, timeout), timeout)
+        return self.call(kind, lambda timeout: execute_adb(["adb", "-s", self.device, "shell", command], timeout),
+                         timeout)
+
+    def exec_out(self, command):
+        kind = command_kind(command)
+        if self.adb:
+            return self.call(kind, lambda timeout: self.adb.exec_out(command, timeout))
+        return self.call(kind, lambda timeout: execute_adb_bytes(["adb", "-s", self.device, "exec-out", command],
+                                                                     timeout))
+
+    def open_stream(self, command, timeout=None):
+        timeout = self.timeouts[command_kind(command)] if timeout is None else timeout
+        if self.adb:
+            return self.adb.open_stream(command, timeout)
+        # Nothing reads stderr while the stream is consumed, a pipe could fill up and stall the command
+        proc = subprocess.Popen(["adb", "-s", self.device, "exec-out"] + command.split(), stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, start_new_session=True)
+        return ProcessStream(proc, timeout)
+
+    def pull(self, remote_path, local_path):
+        if self.adb:
+            return self.call("capture", lambda timeout: self.adb.pull(remote_path, local_path, timeout))
+        return self.call("capture", lambda timeout: execute_adb(f"adb -s {self.device} pull {remote_path} {local_path}",
+                                                                timeout))
+
+    def recycle(self):
+        # Drop every connection to the device, then ask adb to reconnect it and wait until it is back
+        if self.session:
+            self.session.close()
+        if self.adb:
+            self.adb.close()
+        execute_adb(f"adb -s {self.device} reconnect", self.timeouts["default"])
+        execute_adb(f"adb -s {self.device} wait-for-device", self.timeouts["default"])
+
+    def close(self):
+        if self.frame_stream:
+            self.frame_stream.stop()
+        self.capture_pool.shutdown()
+        if self.session:
+            self.session.close()
+        if self.adb:
+            self.adb.close()
+        if self.hierarchy_service:
+            self.hierarchy_service.close()
+            execute_adb(f"adb -s {self.device} forward --remove tcp:{self.forward_port}", self.timeouts["default"])
+        metrics = self.monitor.snapshot()
+        if any(counters.get("timeouts") or counters.get("recycles") for counters in metrics.values()):
+            print_with_color(f"adb metrics of {self.device}: {self.monitor.summary()}", "yellow")
+
+    def refresh_profile(self):
+        result = self.shell(PROBE_COMMAND, "default")
+        profile = parse_profile(result) if result != "ERROR" else None
+        if profile is None:
+            return None
+        self.profile = profile
+        self.width, self.height = screen_size(profile)
+        save_profile(self.profile_path, self.device, profile)
+        return profile
+
+    def validate_profile(self):
+        fingerprint = self.shell(FINGERPRINT_COMMAND, "default")
+        if fingerprint != "ERROR" and fingerprint.strip() != self.profile["fingerprint"]:
+            self.refresh_profile()
+
+    def check_rotation(self, frame):
+        # A screenshot with swapped axes means the device was rotated since the profile was taken
+        if frame.size == (self.height, self.width) and self.width != self.height:
+            if self.profile and self.profile["rotation"] is None:
+                # The device does not report its orientation, probing it again would tell nothing new
+                self.width, self.height = frame.size
+            else:
+                print_with_color(f"{self.device} was rotated, refreshing its profile", "yellow")
+                self.refresh_profile()
+            if self.frame_stream:
+                # The recording keeps the size it was started with
+                self.frame_stream.stop()
+                self.start_frame_stream()
+
+    @property
+    def density(self):
+        return self.profile["density"] if self.profile else None
+
+    @property
+    def label_scale(self):
+        # Labels were tuned on screens of about 420 dpi
+        if not self.density:
+            return None
+        return min(max(round(self.density / 420 * 4) / 4, 0.5), 2)
 
     def get_device_size(self):
-        adb_command = f"adb -s {self.device} shell wm size"
-        result = execute_adb(adb_command)
-        if result != "ERROR":
-            return map(int, result.split(": ")[1].split("x"))
-        return 0, 0
+        if not self.profile:
+            self.refresh_profile()
+        return self.width, self.height
 
     def get_screenshot(self, prefix, save_dir):
-        cap_command = f"adb -s {self.device} shell screencap -p " \
+        cap_command = f"screencap -p " \
                       f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')}"
-        pull_command = f"adb -s {self.device} pull " \
-                       f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')} " \
-                       f"{os.path.join(save_dir, prefix + '.png')}"
-        result = execute_adb(cap_command)
+        result = self.shell(cap_command)
         if result != "ERROR":
-            result = execute_adb(pull_command)
+            result = self.pull(os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/'),
+                               os.path.join(save_dir, prefix + '.png'))
             if result != "ERROR":
                 return os.path.join(save_dir, prefix + ".png")
             return result
         return result
 
+    def capture_screenshot(self, prefix, save_dir):
+        # Stream the screenshot straight from the device into memory. The copy on disk is only kept for the record.
+        if self.screenshot_format == "raw" and self.raw_supported:
+            # Skip the PNG encoding on the device and wrap the uncompressed pixels as they arrive
+            data = self.exec_out("screencap")
+            frame = self.wrap_raw(data)
+            if frame:
+                self.check_rotation(frame)
+                artifacts.save_image(os.path.join(save_dir, prefix + ".png"), frame)
+                return frame
+        data = self.exec_out("screencap -p")
+        if data == "ERROR" or not data:
+            path = self.get_screenshot(prefix, save_dir)
+            if path == "ERROR":
+                return path
+            return Frame(path=path)
+        frame = Frame(data=data)
+        self.check_rotation(frame)
+        artifacts.save_image(os.path.join(save_dir, prefix + ".png"), frame)
+        return frame
+
+    def get_focus(self):
+        result = self.shell("dumpsys window | grep -E 'mCurrentFocus|mFocusedApp'")
+        if result == "ERROR":
+            return None
+        return " ".join(result.split())
+
+    def current_screen_key(self, max_age=None):
+        # The foreground activity and focused window, a probe of a few milliseconds on the device compared to a full
+        # screenshot and dump. It is cached for SCREEN_KEY_TTL seconds and dropped after every input.
+        max_age = configs["SCREEN_KEY_TTL"] if max_age is None else max_age
+        if self.screen_key is not None and time.time() - self.screen_key_time <= max_age:
+            return self.screen_key
+        focus = self.get_focus()
+        key = parse_screen_key(focus) if focus else None
+        if key is None:
+            activities = self.shell("dumpsys activity activities | grep -E 'mResumedActivity|topResumedActivity'")
+            key = parse_screen_key(activities) if activities != "ERROR" else None
+        self.screen_key = key
+        self.screen_key_time = time.time()
+        return key
+
+    def start_frame_stream(self):
+        # Record the screen at a reduced size, which is plenty for comparing frames and keeps the decoding cheap.
+        # H.264 encoders want dimensions that are a multiple of 16.
+        if not self.width or not self.height:
+            return None
+        scale = configs["FRAME_STREAM_SCALE"]
+        width = max(16, int(self.width * scale) // 16 * 16)
+        height = max(16, int(self.height * scale) // 16 * 16)
+        command = f"screenrecord --output-format=h264 --size {width}x{height} -"
+        self.frame_stream = FrameStream(lambda: self.open_stream(command, 0), width, height,
+                                        configs["FRAME_STREAM_BUFFER"], configs["FFMPEG_PATH"]).start()
+        return self.frame_stream
+
+    def latest_frame(self):
+        # The most recent frame of the screen recording, which costs no adb call at all
+        if self.frame_stream is None or not self.frame_stream.running:
+            return None
+        return self.frame_stream.latest_frame()
+
+    def wrap_raw(self, data):
+        if data == "ERROR" or not data:
+            return None
+        frame = Frame.from_raw(data)
+        if frame is None and not raw_format_supported(data):
+            # Every further raw capture would download the whole framebuffer only to be thrown away
+            print_with_color("The raw pixel format of the device is not supported, capturing PNG from now on",
+                             "yellow")
+            self.raw_supported = False
+        return frame
+
+    def get_frame_signature(self):
+        frame = self.latest_frame()
+        if frame is not None:
+            return frame_signature(frame)
+        frame = None
+        if self.raw_supported:
+            data = self.exec_out("screencap")
+            if data == "ERROR" or not data:
+                return None
+            frame = self.wrap_raw(data)
+        if frame is None:
+            data = self.exec_out("screencap -p")
+            if data == "ERROR" or not data:
+                return None
+            frame = Frame(data=data)
+        return frame_signature(frame)
+
+    def get_xml_signature(self):
+        data = self.fetch_hierarchy()
+        if data == "ERROR":
+            data = self.exec_out("uiautomator dump /dev/tty")
+        if data == "ERROR" or b"</hierarchy>" not in data:
+            return None
+        return hashlib.sha1(data[:data.rfind(b"</hierarchy>")]).hexdigest()
+
+    def get_screen_signature(self):
+        # A failed sample only means that the screen is not settled yet, e.g. the focus is null during an activity
+        # transition or a screencap timed out. A signal is only given up on after failing several samples in a row.
+        signature = []
+        failed = False
+        for signal in list(self.settle_signals):
+            if signal == "frame":
+                value = self.get_frame_signature()
+            elif signal == "focus":
+                value = self.current_screen_key(0)
+            elif signal == "xml":
+                value = self.get_xml_signature()
+            else:
+                value = None
+            if value is None:
+                failed = True
+                self.settle_failures[signal] = self.settle_failures.get(signal, 0) + 1
+                if signal not in SETTLE_SIGNALS or self.settle_failures[signal] >= configs["SETTLE_SIGNAL_FAILURES"]:
+                    print_with_color(f"WARNING: settle signal {signal} is unavailable and will be ignored", "yellow")
+                    self.settle_signals.remove(signal)
+                continue
+            self.settle_failures[signal] = 0
+            signature.append(value)
+        if failed:
+            return None
+        return tuple(signature)
+
+    def wait_for_settle(self, timeout=None, interval=None, stable_samples=None):
+        # Wait until the screen stops changing after an action instead of sleeping for a fixed time
+        timeout = configs["SETTLE_TIMEOUT"] if timeout is None else timeout
+        interval = configs["SETTLE_INTERVAL"] if interval is None else interval
+        stable_samples = configs["SETTLE_SAMPLES"] if stable_samples is None else stable_samples
+        if not self.settle_signals:
+            time.sleep(configs["REQUEST_INTERVAL"])
+            return True
+        settled = wait_until_stable(self.get_screen_signature, timeout, interval, stable_samples)
+        if not self.settle_signals:
+            # Every signal was given up on during the wait
+            time.sleep(configs["REQUEST_INTERVAL"])
+            return True
+        if not settled:
+            print_with_color(f"The screen did not settle within {timeout} seconds", "yellow")
+        return settled
+
+    def connect_hierarchy_service(self):
+        # Let adb pick a free local port, so that several devices can be forwarded at the same time
+        port = execute_adb(f"adb -s {self.device} forward tcp:0 tcp:{configs['HIERARCHY_SERVICE_PORT']}",
+                           self.timeouts["default"])
+        if port == "ERROR" or not port.isdigit():
+            print_with_color("The hierarchy service could not be forwarded, falling back to uiautomator dump", "yellow")
+            self.xml_backend = "uiautomator"
+            return None
+        self.forward_port = port
+        self.hierarchy_service = HierarchyService(f"http://127.0.0.1:{port}{configs['HIERARCHY_SERVICE_PATH']}")
+        return self.hierarchy_service
+
+    def fetch_hierarchy(self):
+        if self.xml_backend != "service":
+            return "ERROR"
+        if self.hierarchy_service is None and self.connect_hierarchy_service() is None:
+            return "ERROR"
+        # The service has a connection of its own, its timeouts say nothing about adb and must not get a healthy device
+        # recycled by the watchdog. They are only counted.
+        data = self.hierarchy_service.fetch(self.timeouts["dump"])
+        self.monitor.count("service", "calls")
+        if last_call_timed_out():
+            self.monitor.count("service", "timeouts")
+        if data == "ERROR" and self.hierarchy_service.connection_failed:
+            # A service that is down would otherwise hold up every capture before it falls back
+            print_with_color("The hierarchy service is down, falling back to uiautomator dump from now on", "yellow")
+            self.xml_backend = "uiautomator"
+        elif data == "ERROR":
+            print_with_color("Falling back to uiautomator dump for this capture", "yellow")
+        return data
+
     def get_xml(self, prefix, save_dir):
-        dump_command = f"adb -s {self.device} shell uiautomator dump " \
+        data = self.fetch_hierarchy()
+        if data != "ERROR":
+            with open(os.path.join(save_dir, prefix + ".xml"), "wb") as f:
+                f.write(data)
+            return os.path.join(save_dir, prefix + ".xml")
+        dump_command = f"uiautomator dump " \
                        f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')}"
-        pull_command = f"adb -s {self.device} pull " \
-                       f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')} " \
-                       f"{os.path.join(save_dir, prefix + '.xml')}"
-        result = execute_adb(dump_command)
+        result = self.shell(dump_command)
         if result != "ERROR":
-            result = execute_adb(pull_command)
+            result = self.pull(os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/'),
+                               os.path.join(save_dir, prefix + '.xml'))
             if result != "ERROR":
                 return os.path.join(save_dir, prefix + ".xml")
             return result
         return result
     
-    def get_screenshot_with_bbox(self, screenshot_before, save_dir, tl, br):
-        # Copy the screenshot_before image
-        img_path = save_dir
-        shutil.copy(screenshot_before, img_path)
+    def get_elements(self, prefix, save_dir, attribs=("clickable", "focusable"), add_index=False, skip_uids=(),
+                     nodes=None):
+        data = self.fetch_hierarchy()
+        if data != "ERROR":
+            try:
+                elem_list = extract_elements(io.BytesIO(data), attribs, add_index, skip_uids, nodes)
+            except ET.ParseError as e:
+                print_with_color(f"Hierarchy service returned invalid XML: {e}", "red")
+                return "ERROR"
+            with open(os.path.join(save_dir, prefix + ".xml"), "wb") as f:
+                f.write(data)
+            return elem_list
+        if not self.xml_stream:
+            xml_path = self.get_xml(prefix, save_dir)
+            if xml_path == "ERROR":
+                return xml_path
+            return extract_elements(xml_path, attribs, add_index, skip_uids, nodes)
+        # Parse the hierarchy while it is still arriving over the pipe, without a file on either side
+        dump_command = "uiautomator dump /dev/tty"
 
-        # Load the copied image
-        img = cv2.imread(img_path)
+        def stream_elements(timeout):
+            set_timed_out(False)
+            stream = self.open_stream(dump_command, timeout)
+            if stream == "ERROR":
+                return stream
+            recorder = StreamRecorder(stream)
+            if nodes is not None:
+                # Start over from an empty node map when a timed out dump is retried
+                nodes.clear()
+            try:
+                elem_list = extract_elements(recorder, attribs, add_index, skip_uids, nodes)
+            except (ET.ParseError, OSError) as e:
+                set_timed_out(isinstance(e, socket.timeout) or getattr(stream, "timed_out", False))
+                print_with_color(f"Command execution failed: exec-out {dump_command}", "red")
+                print_with_color(f"{e}\n{b''.join(recorder.chunks).decode(errors='replace')}", "red")
+                return "ERROR"
+            finally:
+                stream.close()
+            recorder.save(os.path.join(save_dir, prefix + ".xml"))
+            return elem_list
 
-        # Draw the bounding box on the image
-        cv2.rectangle(img, (int(tl[0]), int(tl[1])), (int(br[0]), int(br[1])), (0, 255, 0), 2)
+        return self.call("dump", stream_elements)
 
-        # Save the image with the bounding box
-        cv2.imwrite(img_path, img)
+    def capture_state(self, prefix, save_dir, attribs=("clickable", "focusable"), add_index=False, skip_uids=(),
+                      xml_prefix=None, xml_dir=None, previous=None):
+        # The screenshot and the hierarchy dump are independent, so run them side by side instead of one after the other
+        started = time.time()
+        input_count = self.input_count
+        nodes = {}
+        skip_uids = frozenset(skip_uids)
+        xml_path = os.path.join(xml_dir or save_dir, (xml_prefix or prefix) + ".xml")
 
-        return img_path
+        def screenshot(probe=True):
+            frame = self.capture_screenshot(prefix, save_dir)
+            screenshot_time = time.time()
+            if probe:
+                # Probe the screen key while the dump is still running, it is cached for the next comparison
+                self.current_screen_key()
+            return frame, screenshot_time
 
+        def elements():
+            elem_list = self.get_elements(xml_prefix or prefix, xml_dir or save_dir, attribs, add_index, skip_uids,
+                                          nodes)
+            return elem_list, time.time()
 
-    def draw_circle(self, x, y, img_path, r=10, thickness=2):
-        img = cv2.imread(img_path)
+        if previous is not None and previous.ok and previous.skip_uids == skip_uids and previous.screen_key and \
+                previous.input_count == input_count:
+            # Only tried when no input was sent since the previous capture, after an input the screen has most likely
+            # changed and waiting for the screenshot before starting the dump would only add to the round.
+            # The screen key is probed alongside the screenshot. Still being on the same activity says little in single
+            # activity apps where a scroll or a tab switch keeps the key, so the hierarchy of the previous state is
+            # only reused when the screen also looks the same. The dump is not started before that is known, a dump
+            # left running would go on into the next action and could clash with the next capture.
+            key_future = self.capture_pool.submit(self.current_screen_key)
+            frame, screenshot_time = screenshot(False)
+            if key_future.result() == previous.screen_key and frame != "ERROR" and \
+                    frame_signature(frame) == previous.signature:
+                if previous.xml_path and previous.xml_path != xml_path and os.path.isfile(previous.xml_path):
+                    shutil.copyfile(previous.xml_path, xml_path)
+                return ScreenState(frame, previous.elem_list, previous.nodes, started, screenshot_time, started,
+                                   xml_path, previous.screen_key, skip_uids, True, input_count)
+            elem_list, xml_time = elements()
+        else:
+            screenshot_future = self.capture_pool.submit(screenshot)
+            elem_list, xml_time = elements()
+            frame, screenshot_time = screenshot_future.result()
+        return ScreenState(frame, elem_list, nodes, started, screenshot_time, xml_time, xml_path, self.screen_key,
+                           skip_uids, input_count=input_count)
+
+    def get_screenshot_with_bbox(self, screenshot_before, tl, br):
+        # Draw the bounding box on a copy of the screenshot_before image
+        img = read_image(screenshot_before)
+        cv2.rectangle(img, (int(tl[0]), int(tl[1])), (int(br[0]), int(br[1])), (0, 255, 0), 2)
+        return img
+
+    def draw_circle(self, x, y, img, r=10, thickness=2):
         cv2.circle(img, (int(x), int(y)), r, (0, 0, 255), thickness)
-        cv2.imwrite(img_path, img)
+        return img
 
     def draw_arrow(x, y, direction, image_path, arrow_length=50, arrow_color=(0, 255, 0), thickness=2):
         img = cv2.imread(image_path)
@@ -178,9 +1221,7 @@ class AndroidController:
         # Save the modified image
         cv2.imwrite(image_path, img)
 
-    def draw_arrow(self, x, y, direction, dist, image_path, arrow_color=(0, 255, 0), thickness=2):
-        img = cv2.imread(image_path)
-        
+    def draw_arrow(self, x, y, direction, dist, img, arrow_color=(0, 255, 0), thickness=2):
         # Calculate the arrow length based on the screen width and dist
         screen_width = img.shape[1]
         unit_dist = int(screen_width / 10)
@@ -205,34 +1246,65 @@ class AndroidController:
         
         # Draw the arrow
         cv2.arrowedLine(img, (x, y), end_point, arrow_color, thickness)
-        
-        # Save the modified image
-        cv2.imwrite(image_path, img)
+        return img
 
     def back(self):
-        adb_command = f"adb -s {self.device} shell input keyevent KEYCODE_BACK"
-        ret = execute_adb(adb_command)
+        ret = self.shell(input_keyevent("KEYCODE_BACK"))
         return ret
 
     def tap(self, x, y):
-        adb_command = f"adb -s {self.device} shell input tap {x} {y}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(input_tap(x, y))
         return ret
 
+    def fast_text_ready(self):
+        # The broadcast is only received while ADBKeyboard is the active input method. "am broadcast" succeeds whether
+        # or not anything receives it, so the input method is checked again every IME_CHECK_INTERVAL seconds and after
+        # every failed text input, in case the keyboard was switched in the meantime.
+        if self.fast_text is None or time.time() - self.fast_text_time > configs["IME_CHECK_INTERVAL"]:
+            ime = self.shell("settings get secure default_input_method", "default")
+            fast_text = ime != "ERROR" and ime.strip() == ADB_KEYBOARD_IME
+            if not fast_text and self.fast_text is not False:
+                print_with_color("ADBKeyboard is not the active input method, falling back to input text", "yellow")
+            self.fast_text = fast_text
+            self.fast_text_time = time.time()
+        return self.fast_text
+
+    def text_command(self, input_str):
+        if self.text_input_mode == "adbkeyboard" and self.fast_text_ready():
+            # The whole string is committed by the IME in one go, with spaces and quotes intact
+            msg = base64.b64encode(input_str.encode()).decode()
+            return f"am broadcast -a ADB_INPUT_B64 --es msg {msg}"
+        return input_text(input_str)
+
     def text(self, input_str):
-        input_str = input_str.replace(" ", "%s")
-        input_str = input_str.replace("'", "")
-        adb_command = f"adb -s {self.device} shell input text {input_str}"
-        ret = execute_adb(adb_command)
+        if "\n" in input_str:
+            # Neither "input text" nor the device shell can take a line break, the shell would run the rest of the
+            # text as a command. Each line is typed on its own with an enter key in between, all in one round trip.
+            batch = self.batch()
+            for i, line in enumerate(input_str.split("\n")):
+                if i:
+                    batch.enter()
+                if line:
+                    batch.text(line)
+            ret = batch.run()
+            if ret == "ERROR":
+                self.fast_text = None
+            return ret
+        ret = self.shell(self.text_command(input_str))
+        if ret == "ERROR" and self.text_input_mode == "adbkeyboard" and self.fast_text:
+            self.fast_text = None
+            ret = self.shell(input_text(input_str))
         return ret
 
     def long_press(self, x, y, duration=1000):
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x} {y} {duration}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(input_swipe(x, y, x, y, duration))
         return ret
 
-    def swipe(self, x, y, direction, dist="medium", quick=False):
-        unit_dist = int(self.width / 10)
+    def swipe_offset(self, direction, dist="medium"):
+        if self.density:
+            unit_dist = int(configs["SWIPE_UNIT_DP"] * self.density / 160)
+        else:
+            unit_dist = int(self.width / 10)
         if dist == "long":
             unit_dist *= 3
         elif dist == "medium":
@@ -246,15 +1318,26 @@ class AndroidController:
         elif direction == "right":
             offset = unit_dist, 0
         else:
-            return "ERROR"
+            return None
+        return offset
+
+    def swipe_command(self, x, y, direction, dist="medium", quick=False):
+        offset = self.swipe_offset(direction, dist)
+        if offset is None:
+            return None
         duration = 100 if quick else 400
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x+offset[0]} {y+offset[1]} {duration}"
-        ret = execute_adb(adb_command)
+        return input_swipe(x, y, x + offset[0], y + offset[1], duration)
+
+    def swipe(self, x, y, direction, dist="medium", quick=False):
+        command = self.swipe_command(x, y, direction, dist, quick)
+        if command is None:
+            return "ERROR"
+        ret = self.shell(command)
         return ret
 
     def swipe_precise(self, start, end, duration=400):
-        start_x, start_y = start
-        end_x, end_y = end
-        adb_command = f"adb -s {self.device} shell input swipe {start_x} {start_x} {end_x} {end_y} {duration}"
-        ret = execute_adb(adb_command)
+        ret = self.shell(input_swipe(*start, *end, duration))
         return ret
+
+    def batch(self):
+        return ActionBatch(self)
@@ -0,0 +1,69 @@
+import json
+import os
+import re
+import threading
+
+# One command that collects everything in a single round trip. grep exits with 1 on devices that do not report the
+# orientation, so the script always ends with true.
+PROBE_COMMAND = "wm size; wm density; echo sdk=$(getprop ro.build.version.sdk); " \
+                "echo fingerprint=$(getprop ro.build.fingerprint); dumpsys input | grep -m 1 SurfaceOrientation; true"
+FINGERPRINT_COMMAND = "getprop ro.build.fingerprint"
+
+profile_lock = threading.Lock()
+
+
+def parse_profile(output):
+    # Overrides set with "wm size" or "wm density" win over the physical values
+    sizes = dict(re.findall(r"(Physical|Override) size: (\d+x\d+)", output))
+    densities = dict(re.findall(r"(Physical|Override) density: (\d+)", output))
+    size = sizes.get("Override") or sizes.get("Physical")
+    if not size:
+        return None
+    width, height = map(int, size.split("x"))
+    density = densities.get("Override") or densities.get("Physical")
+    sdk = re.search(r"sdk=(\d+)", output)
+    fingerprint = re.search(r"fingerprint=(\S*)", output)
+    orientation = re.search(r"SurfaceOrientation: (\d)", output)
+    return {
+        "width": width,
+        "height": height,
+        "density": int(density) if density else None,
+        "sdk": int(sdk.group(1)) if sdk else None,
+        "fingerprint": fingerprint.group(1) if fingerprint else "",
+        # None when the device does not report it, the screenshots are the only source of the orientation then
+        "rotation": int(orientation.group(1)) if orientation else None,
+    }
+
+
+def load_profiles(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_profile(path, device):
+    with profile_lock:
+        return load_profiles(path).get(device)
+
+
+def save_profile(path, device, profile):
+    # Several controllers may share the file, so re-read it and replace it in one step
+    with profile_lock:
+        profiles = load_profiles(path)
+        profiles[device] = profile
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(profiles, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def screen_size(profile):
+    # "wm size" reports the natural orientation, a quarter turn swaps the axes
+    if profile["rotation"] and profile["rotation"] % 2:
+        return profile["height"], profile["width"]
+    return profile["width"], profile["height"]
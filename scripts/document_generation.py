@@ -8,7 +8,7 @@ import time
 
 import prompts
 from config import load_config
-from model import OpenAIModel, QwenModel
+from model import OpenAIModel, QwenModel, image_cache
 from utils import print_with_color
 
 arg_desc = "AppAgent - Human Demonstration"
@@ -132,3 +132,4 @@ with open(record_path, "r") as infile:
         time.sleep(configs["REQUEST_INTERVAL"])
 
 print_with_color(f"Documentation generation phase completed. {doc_count} docs generated.", "yellow")
+print_with_color(f"Image cache: {image_cache.summary()}", "yellow")
@@ -17,6 +17,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 
+from utils import frame_signature, wait_until_stable, artifacts
+
 
 def find_canvas_id(node_id, nodes, canvas_id=None):
     for node in nodes:
@@ -85,8 +87,7 @@ def draw_bbox_multi(img_path, output_path, predictions, dark_mode=False):
 
 
 def append_to_log(text: str, log_file: str, break_line: bool = True):
-    with open(log_file, "a") as f:
-        f.write(text + ("\n" if break_line else ""))
+    artifacts.append(log_file, text + ("\n" if break_line else ""))
 
 def move_to_static(file_path, static_dir):
     unique_id = str(uuid.uuid4())
@@ -197,7 +198,9 @@ class SeleniumController:
         # Take a screenshot of the <canvas> element
         canvas = self.driver.find_element(By.TAG_NAME, "canvas")
         screenshot = canvas.screenshot_as_png
+        self.save_screenshot(screenshot, x, y, width, height, save_path)
 
+    def save_screenshot(self, screenshot, x, y, width, height, save_path):
         # Convert the screenshot to an Image object
         img = Image.open(BytesIO(screenshot))
 
@@ -207,7 +210,31 @@ class SeleniumController:
         # Save the cropped image
         cropped_img.save(save_path)
 
-    def take_canvas_screenshot(self, screenshot_path, tl, br, output_path):
+    def capture_state(self, x, y, width, height, save_path, nodes):
+        # The driver can only serve one command at a time, so the screenshot and the node lookup run one after the
+        # other
+        canvas = self.driver.find_element(By.TAG_NAME, "canvas")
+        screenshot = canvas.screenshot_as_png
+        current_node_id = self.get_current_node_id()
+        self.save_screenshot(screenshot, x, y, width, height, save_path)
+        return find_node_by_id(current_node_id, nodes)
+
+    def get_frame_signature(self):
+        try:
+            canvas = self.driver.find_element(By.TAG_NAME, "canvas")
+            screenshot = canvas.screenshot_as_png
+        except Exception:
+            return None
+        img = cv2.imdecode(np.frombuffer(screenshot, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        return frame_signature(img)
+
+    def wait_for_settle(self, timeout, interval, stable_samples):
+        # Wait until the prototype finishes its transition instead of sleeping for a fixed time
+        return wait_until_stable(self.get_frame_signature, timeout, interval, stable_samples)
+
+    def take_canvas_screenshot(self, screenshot_path, tl, br):
         # Load the existing screenshot
         img = Image.open(screenshot_path)
 
@@ -220,18 +247,13 @@ class SeleniumController:
             imgcv, (int(tl[0]), int(tl[1])), (int(br[0]), int(br[1])), (0, 255, 0), 2
         )
 
-        # Save the image
-        cv2.imwrite(output_path, imgcv)
+        return imgcv
 
-
-    def draw_circle(self, x, y, img_path, r=10, thickness=2):
-        img = cv2.imread(img_path)
+    def draw_circle(self, x, y, img, r=10, thickness=2):
         cv2.circle(img, (int(x), int(y)), r, (0, 0, 255), thickness)
-        cv2.imwrite(img_path, img)
+        return img
     
-    def draw_arrow(self, x, y, direction, dist, image_path, arrow_color=(0, 255, 0), thickness=2):
-        img = cv2.imread(image_path)
-        
+    def draw_arrow(self, x, y, direction, dist, img, arrow_color=(0, 255, 0), thickness=2):
         # Calculate the arrow length based on the screen width and dist
         screen_width = img.shape[1]
         unit_dist = int(screen_width / 10)
@@ -256,9 +278,7 @@ class SeleniumController:
         
         # Draw the arrow
         cv2.arrowedLine(img, (x, y), end_point, arrow_color, thickness)
-        
-        # Save the modified image
-        cv2.imwrite(image_path, img)
+        return img
 
     def get_current_node_id(self):
         # Get the current URL
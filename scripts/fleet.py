@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+
+from and_controller import AndroidController
+from utils import print_with_color
+
+
+class DeviceStats:
+    def __init__(self, device):
+        self.device = device
+        self.tasks = 0
+        self.completed = 0
+        self.rounds = 0
+        self.busy_time = 0.0
+        self.started = time.time()
+        self.finished = None
+
+    def record(self, status, rounds, elapsed):
+        self.tasks += 1
+        if status == "completed":
+            self.completed += 1
+        self.rounds += rounds
+        self.busy_time += elapsed
+
+    def summary(self):
+        wall_time = (self.finished or time.time()) - self.started
+        tasks_per_hour = self.tasks * 3600 / wall_time if wall_time > 0 else 0
+        rounds_per_minute = self.rounds * 60 / self.busy_time if self.busy_time > 0 else 0
+        return f"{self.device}: {self.completed}/{self.tasks} tasks completed, {self.rounds} rounds, " \
+               f"{tasks_per_hour:.1f} tasks/h, {rounds_per_minute:.1f} rounds/min, " \
+               f"busy {self.busy_time:.0f}s of {wall_time:.0f}s"
+
+
+def run_fleet(devices, tasks, run_task, controller_factory=AndroidController):
+    # One worker thread per device pulls the next task as soon as its device is idle.
+    # run_task(controller, task_index, task_desc) returns the final status and the number of rounds played.
+    task_queue = queue.Queue()
+    for task_index, task_desc in enumerate(tasks):
+        task_queue.put((task_index, task_desc))
+    stats = {device: DeviceStats(device) for device in devices}
+
+    def worker(device):
+        device_stats = stats[device]
+        try:
+            controller = controller_factory(device)
+        except Exception as e:
+            print_with_color(f"ERROR: failed to connect to {device}: {e}", "red")
+            device_stats.finished = time.time()
+            return
+        try:
+            if not controller.width and not controller.height:
+                print_with_color(f"ERROR: Invalid device size of {device}!", "red")
+                return
+            while True:
+                try:
+                    task_index, task_desc = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                print_with_color(f"[{device}] Starting task {task_index + 1}: {task_desc}", "yellow")
+                start = time.time()
+                try:
+                    status, rounds = run_task(controller, task_index, task_desc)
+                except Exception as e:
+                    print_with_color(f"[{device}] ERROR: task {task_index + 1} crashed: {e}", "red")
+                    status, rounds = "error", 0
+                device_stats.record(status, rounds, time.time() - start)
+                print_with_color(f"[{device}] Task {task_index + 1} finished with status {status} after {rounds} "
+                                 f"rounds", "yellow")
+        finally:
+            device_stats.finished = time.time()
+            controller.close()
+
+    threads = [threading.Thread(target=worker, args=(device,), daemon=True) for device in devices]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not task_queue.empty():
+        print_with_color(f"ERROR: {task_queue.qsize()} tasks were left unscheduled as no device was available", "red")
+    for device in devices:
+        print_with_color(stats[device].summary(), "cyan")
+    return stats
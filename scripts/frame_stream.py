@@ -0,0 +1,124 @@
+import collections
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from utils import Frame, print_with_color
+
+
+class FrameStream:
+    # Keeps the screen recording of a device running and decodes it in the background, so that the latest frames are
+    # always at hand without another adb call. open_source() returns a binary stream of raw H.264, e.g. the output of
+    # screenrecord, or "ERROR". The decoder scales every frame to width x height and converts it to BGR.
+    def __init__(self, open_source, width, height, buffer_size=8, decoder="ffmpeg", max_failures=3):
+        self.open_source = open_source
+        self.width = width
+        self.height = height
+        self.decoder = decoder
+        self.max_failures = max_failures
+        self.frames = collections.deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.source = None
+        self.proc = None
+        self.thread = None
+        self.frame_count = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        # screenrecord ends after its time limit or when the connection drops, so it is restarted until the stream is
+        # stopped. A recording that fails before delivering a single frame counts as a failure.
+        failures = 0
+        while not self.stopped.is_set():
+            source = self.open_source()
+            if source == "ERROR":
+                decoded = 0
+            else:
+                try:
+                    decoded = self.decode(source)
+                except OSError as e:
+                    print_with_color(f"ERROR: the frame decoder could not be started: {e}", "red")
+                    return
+            if self.stopped.is_set():
+                break
+            failures = 0 if decoded else failures + 1
+            if failures >= self.max_failures:
+                print_with_color("ERROR: the screen recording keeps failing, the frame stream is stopped", "red")
+                return
+            time.sleep(1 if failures else 0)
+
+    def decode(self, source):
+        # Probe as little of the input as possible and decode on a single thread, so that every frame comes out as
+        # soon as its bytes are in
+        command = [self.decoder, "-loglevel", "error", "-probesize", "32", "-analyzeduration", "0",
+                   "-flags", "low_delay", "-threads", "1", "-f", "h264", "-i", "pipe:0", "-vf", f"scale={self.width}:{self.height}",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+        self.source = source
+        try:
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+        except OSError:
+            source.close()
+            raise
+        feeder = threading.Thread(target=self.feed, args=(source, self.proc.stdin), daemon=True)
+        feeder.start()
+        frame_size = self.width * self.height * 3
+        decoded = 0
+        while True:
+            data = self.proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            image = np.frombuffer(data, np.uint8).reshape(self.height, self.width, 3)
+            with self.lock:
+                self.frames.append((time.time(), Frame(image=image)))
+                self.frame_count += 1
+            decoded += 1
+        self.proc.stdout.close()
+        self.proc.wait()
+        source.close()
+        feeder.join(timeout=5)
+        return decoded
+
+    def feed(self, source, sink):
+        # Pass the bytes on as soon as they arrive rather than waiting for a full buffer
+        read = getattr(source, "read1", source.read)
+        try:
+            while not self.stopped.is_set():
+                data = read(64 * 1024)
+                if not data:
+                    break
+                sink.write(data)
+                sink.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                sink.close()
+            except OSError:
+                pass
+
+    def latest_frame(self):
+        with self.lock:
+            return self.frames[-1][1] if self.frames else None
+
+    def stop(self):
+        self.stopped.set()
+        if self.source is not None:
+            try:
+                self.source.close()
+            except (OSError, ValueError):
+                pass
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
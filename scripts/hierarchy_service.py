@@ -0,0 +1,46 @@
+import requests
+
+from adb_client import set_timed_out
+from utils import print_with_color
+
+
+class HierarchyService:
+    # Client of a long-running hierarchy provider on the device, such as an instrumentation server or an accessibility
+    # service, reached through adb forward. It returns the current hierarchy as uiautomator XML straight from memory,
+    # without writing a dump file or waiting for the screen to become idle.
+    def __init__(self, url, connect_timeout=2):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.session = requests.Session()
+        self.connection_failed = False
+
+    def fetch(self, timeout=None):
+        # The forwarded port accepts connections right away, so connecting only takes long when something is wrong.
+        # The timeout of the request itself applies to reading the response.
+        set_timed_out(False)
+        try:
+            response = self.session.get(self.url, timeout=(self.connect_timeout, timeout))
+            response.raise_for_status()
+        except requests.ConnectionError as e:
+            # Nothing listens on the device, or adb dropped the forward
+            self.connection_failed = True
+            print_with_color(f"Hierarchy service is not reachable: {self.url}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+        except requests.Timeout as e:
+            set_timed_out(True)
+            print_with_color(f"Hierarchy service timed out: {self.url}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+        except requests.RequestException as e:
+            print_with_color(f"Hierarchy service request failed: {self.url}", "red")
+            print_with_color(str(e), "red")
+            return "ERROR"
+        data = response.content
+        if b"<hierarchy" not in data:
+            print_with_color(f"Hierarchy service returned no hierarchy: {self.url}", "red")
+            return "ERROR"
+        return data
+
+    def close(self):
+        self.session.close()
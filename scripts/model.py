@@ -1,4 +1,7 @@
+import math
+import os
 import re
+import tempfile
 from abc import abstractmethod
 from typing import List
 from http import HTTPStatus
@@ -6,18 +9,57 @@ from http import HTTPStatus
 import requests
 import dashscope
 
-from utils import print_with_color, encode_image
+from config import load_config
+from utils import print_with_color, ImageCache, RequestThrottle
 
 from typing import List, Tuple
 
+configs = load_config()
+image_cache = ImageCache(configs["IMAGE_CACHE_SIZE"] * 1024 * 1024)
+
+
+def openai_image_tokens(width, height):
+    # High detail images are fit into 2048 x 2048, scaled down to 768 on the short side and billed per 512 px tile
+    scale = min(1, 2048 / max(width, height))
+    scale *= min(1, 768 / (min(width, height) * scale))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def qwen_image_tokens(width, height):
+    # One token per 28 x 28 patch, plus the tokens that open and close the image
+    return math.ceil(width / 28) * math.ceil(height / 28) + 2
+
+
 class BaseModel:
     def __init__(self):
-        pass
+        # Largest image the model looks at, anything larger is scaled down by the provider anyway
+        self.max_short_side = 0
+        self.max_long_side = 0
+        self.max_pixels = 0
+        # Spaces out the requests of each device that uses this client
+        self.throttle = RequestThrottle(configs["REQUEST_INTERVAL"])
 
     @abstractmethod
     def get_model_response(self, prompt: str, images: List[str]) -> Tuple[bool, str]:
         pass
 
+    def estimate_image_tokens(self, width, height):
+        return 0
+
+    def prepare_images(self, images):
+        prepared = []
+        cached = 0
+        for img in images:
+            img, hit = image_cache.prepare(img, self.max_short_side, self.max_long_side, self.max_pixels,
+                                           configs["IMAGE_FORMAT"], configs["IMAGE_QUALITY"])
+            prepared.append(img)
+            cached += hit
+        size = sum(len(img.data) for img in prepared)
+        tokens = sum(self.estimate_image_tokens(img.width, img.height) for img in prepared)
+        print_with_color(f"Uploading {len(prepared)} images of {size / 1024:.0f} KB ({cached} cached), about {tokens} "
+                         f"image tokens", "yellow")
+        return prepared
+
 class OpenAIModel(BaseModel):
     def __init__(self, base_url: str, api_key: str, model: str, temperature: float, max_tokens: int):
         super().__init__()
@@ -26,6 +68,11 @@ class OpenAIModel(BaseModel):
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
+        self.max_short_side = configs["IMAGE_MAX_SHORT_SIDE"]
+        self.max_long_side = configs["IMAGE_MAX_LONG_SIDE"]
+
+    def estimate_image_tokens(self, width, height):
+        return openai_image_tokens(width, height)
 
     def get_model_response(self, prompt: str, images: List[str]) -> Tuple[bool, str]:
         content = [
@@ -34,12 +81,11 @@ class OpenAIModel(BaseModel):
                 "text": prompt
             }
         ]
-        for img in images:
-            base64_img = encode_image(img)
+        for img in self.prepare_images(images):
             content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_img}"
+                    "url": img.data_url
                 }
             })
         headers = {
@@ -74,16 +120,24 @@ class QwenModel(BaseModel):
     def __init__(self, api_key: str, model: str):
         super().__init__()
         self.model = model
+        self.max_pixels = configs["QWEN_MAX_PIXELS"]
         dashscope.api_key = api_key
 
+    def estimate_image_tokens(self, width, height):
+        return qwen_image_tokens(width, height)
+
     def get_model_response(self, prompt: str, images: List[str]) -> Tuple[bool, str]:
         content = [{
             "text": prompt
         }]
-        for img in images:
-            img_path = f"file://{img}"
+        # dashscope uploads local files itself, so the prepared images go through temporary files
+        img_paths = []
+        for img in self.prepare_images(images):
+            with tempfile.NamedTemporaryFile(suffix=img.ext, delete=False) as f:
+                f.write(img.data)
+            img_paths.append(f.name)
             content.append({
-                "image": img_path
+                "image": f"file://{f.name}"
             })
         messages = [
             {
@@ -91,7 +145,11 @@ class QwenModel(BaseModel):
                 "content": content
             }
         ]
-        response = dashscope.MultiModalConversation.call(model=self.model, messages=messages)
+        try:
+            response = dashscope.MultiModalConversation.call(model=self.model, messages=messages)
+        finally:
+            for img_path in img_paths:
+                os.remove(img_path)
         if response.status_code == HTTPStatus.OK:
             return True, response.output.choices[0].message.content[0]["text"]
         else:
@@ -105,6 +163,11 @@ class AzureModel(BaseModel):
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
+        self.max_short_side = configs["IMAGE_MAX_SHORT_SIDE"]
+        self.max_long_side = configs["IMAGE_MAX_LONG_SIDE"]
+
+    def estimate_image_tokens(self, width, height):
+        return openai_image_tokens(width, height)
 
     def get_model_response(self, prompt: str, images: List[str]) -> Tuple[bool, str]:
         content = [
@@ -113,12 +176,11 @@ class AzureModel(BaseModel):
                 "text": prompt
             }
         ]
-        for img in images:
-            base64_img = encode_image(img)
+        for img in self.prepare_images(images):
             content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_img}"
+                    "url": img.data_url
                 }
             })
         headers = {
@@ -272,7 +272,7 @@ the center of the element. The action of <action> this UI element was described
 <last_act>
 The action was also an attempt to proceed with a larger task, which is to <task_desc> <persona_description>. Your job is to carefully analyze 
 the difference between the two screenshots to determine if the action is in accord with the description above and at 
-the same time effectively moved the task forward. Your output should be determined based on the following situations:
+the same time effectively moved the task forward.<ui_diff> Your output should be determined based on the following situations:
 1. BACK
 If you think the action navigated you to a page where you cannot proceed with the given task, you should go back to the 
 previous interface. At the same time, describe the functionality of the UI element concisely in one or two sentences by 
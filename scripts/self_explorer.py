@@ -9,9 +9,9 @@ import time
 
 import prompts
 from config import load_config
-from and_controller import list_all_devices, AndroidController, traverse_tree, append_to_log
-from model import parse_explore_rsp, parse_reflect_rsp, OpenAIModel, QwenModel, AzureModel
-from utils import print_with_color, draw_bbox_multi
+from and_controller import list_all_devices, AndroidController, HierarchyDiffer, append_to_log, diff_nodes
+from model import parse_explore_rsp, parse_reflect_rsp, OpenAIModel, QwenModel, AzureModel, image_cache
+from utils import print_with_color, draw_bbox_multi, artifacts
 
 arg_desc = "AppAgent - Autonomous Exploration"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
@@ -84,260 +84,262 @@ else:
     print_with_color("Please choose the Android device to start demo by entering its ID:", "blue")
     device = input()
 controller = AndroidController(device)
-width, height = controller.get_device_size()
-if not width and not height:
-    print_with_color("ERROR: Invalid device size!", "red")
-    sys.exit()
-print_with_color(f"Screen resolution of {device}: {width}x{height}", "yellow")
-
-print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
-task_desc = input()
-
-# Get the persona description from the user
-print_with_color("(Optional) Please enter the description of the user persona you'd like me to emulate : ","blue",)
-persona_desc = input()
-
-round_count = 0
-doc_count = 0
-useless_list = set()
-last_act = "None"
-task_complete = False
-
-# Write the report markdown file
-append_to_log(f"# User Testing Report for {app}", report_log_path)
-append_to_log(task_name, report_log_path)
-append_to_log(f"## Task Description", report_log_path)
-append_to_log(task_desc, report_log_path)
-
-# If the user entered a persona description, replace the placeholder with the description
-if persona_desc:
-    persona_desc = f"as a person who is {persona_desc}"
-    append_to_log(f"## Persona Description", report_log_path)
-    append_to_log(persona_desc, report_log_path)
-
-prompt = re.sub(
-    r"<persona_description>",
-    persona_desc,
-    prompts.self_explore_task_with_persona_template,
-)
-
-while round_count < configs["MAX_ROUNDS"]:
-    round_count += 1
-    print_with_color(f"Round {round_count}", "yellow", log_file=report_log_path, heading_level=2)
-    screenshot_before = controller.get_screenshot(f"{round_count}_before", task_dir)
-    xml_path = controller.get_xml(f"{round_count}", task_dir)
-    if screenshot_before == "ERROR" or xml_path == "ERROR":
-        break
-
-    # Add the screenshot to the report markdown file
-    append_to_log(
-        f"![Before action](./{round_count}_before.png)",
-        report_log_path,
-        break_line=False,
+try:
+    width, height = controller.get_device_size()
+    if not width and not height:
+        print_with_color("ERROR: Invalid device size!", "red")
+        sys.exit()
+    print_with_color(f"Screen resolution of {device}: {width}x{height}", "yellow")
+
+    print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
+    task_desc = input()
+
+    # Get the persona description from the user
+    print_with_color("(Optional) Please enter the description of the user persona you'd like me to emulate : ","blue",)
+    persona_desc = input()
+
+    round_count = 0
+    doc_count = 0
+    useless_list = set()
+    last_act = "None"
+    task_complete = False
+    throttle = mllm.throttle
+    differ = HierarchyDiffer()
+    state = None
+
+    # Write the report markdown file
+    append_to_log(f"# User Testing Report for {app}", report_log_path)
+    append_to_log(task_name, report_log_path)
+    append_to_log(f"## Task Description", report_log_path)
+    append_to_log(task_desc, report_log_path)
+
+    # If the user entered a persona description, replace the placeholder with the description
+    if persona_desc:
+        persona_desc = f"as a person who is {persona_desc}"
+        append_to_log(f"## Persona Description", report_log_path)
+        append_to_log(persona_desc, report_log_path)
+
+    prompt = re.sub(
+        r"<persona_description>",
+        persona_desc,
+        prompts.self_explore_task_with_persona_template,
     )
 
-    clickable_list = []
-    focusable_list = []
-    traverse_tree(xml_path, clickable_list, "clickable", True)
-    traverse_tree(xml_path, focusable_list, "focusable", True)
-    elem_list = []
-    for elem in clickable_list:
-        if elem.uid in useless_list:
-            continue
-        elem_list.append(elem)
-    for elem in focusable_list:
-        if elem.uid in useless_list:
-            continue
-        bbox = elem.bbox
-        center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-        close = False
-        for e in clickable_list:
-            bbox = e.bbox
-            center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-            if dist <= configs["MIN_DIST"]:
-                close = True
-                break
-        if not close:
-            elem_list.append(elem)
-    draw_bbox_multi(screenshot_before, os.path.join(task_dir, f"{round_count}_before_labeled.png"), elem_list,
-                    dark_mode=configs["DARK_MODE"])
-    
-    # Add the labeled image to the report markdown file
-    append_to_log(
-        f"![Before action labeled](./{round_count}_before_labeled.png)",
-        report_log_path,
-    )
+    while round_count < configs["MAX_ROUNDS"]:
+        round_count += 1
+        print_with_color(f"Round {round_count}", "yellow", log_file=report_log_path, heading_level=2)
+        state = controller.capture_state(f"{round_count}_before", task_dir, ("clickable", "focusable"), True, useless_list,
+                                         f"{round_count}", previous=state)
+        if not state.ok:
+            break
+        screenshot_before, elem_list = state.frame, state.elem_list
+        ui_diff = differ.update(state.nodes)
+        if round_count > 1 and not ui_diff.changed:
+            print_with_color("The UI hierarchy did not change since the last round", "yellow", log_file=report_log_path)
+
+        # Add the screenshot to the report markdown file
+        append_to_log(
+            f"![Before action](./{round_count}_before.png)",
+            report_log_path,
+            break_line=False,
+        )
 
-    prompt = re.sub(r"<task_description>", task_desc, prompts.self_explore_task_with_persona_template)
-    prompt = re.sub(r"<last_act>", last_act, prompt)
-    base64_img_before = os.path.join(task_dir, f"{round_count}_before_labeled.png")
-    print_with_color("Thinking about what to do in the next step...", "yellow")
-    status, rsp = mllm.get_model_response(prompt, [base64_img_before])
+        base64_img_before = draw_bbox_multi(screenshot_before, os.path.join(task_dir, f"{round_count}_before_labeled.png"),
+                                            elem_list, dark_mode=configs["DARK_MODE"], scale=controller.label_scale)
 
-    if status:
-        with open(explore_log_path, "a") as logfile:
+        # Add the labeled image to the report markdown file
+        append_to_log(
+            f"![Before action labeled](./{round_count}_before_labeled.png)",
+            report_log_path,
+        )
+
+        prompt = re.sub(r"<task_description>", task_desc, prompts.self_explore_task_with_persona_template)
+        prompt = re.sub(r"<last_act>", last_act, prompt)
+        print_with_color("Thinking about what to do in the next step...", "yellow")
+        throttle.wait()
+        status, rsp = mllm.get_model_response(prompt, [base64_img_before])
+
+        if status:
             log_item = {"step": round_count, "prompt": prompt, "image": f"{round_count}_before_labeled.png",
-                        "response": rsp}
-            logfile.write(json.dumps(log_item) + "\n")
-        res = parse_explore_rsp(rsp, log_file=report_log_path)
-        act_name = res[0]
-        last_act = res[-1]
-        res = res[:-1]
-        if act_name == "FINISH":
-            task_complete = True
-            break
-        if act_name == "tap":
-            _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-
-            # Draw a bounding box on the canvas image and save it
-            screenshot_before_actioned = os.path.join(task_dir, f"{round_count}_before_labeled_action.png")
-            controller.get_screenshot_with_bbox(screenshot_before, screenshot_before_actioned, tl, br)
-            controller.draw_circle(x, y, screenshot_before_actioned)
-            
-            ret = controller.tap(x, y)
-            if ret == "ERROR":
-                print_with_color("ERROR: tap execution failed", "red")
+                        "response": rsp, "ui_diff": ui_diff.to_dict(limit=20)}
+            artifacts.append(explore_log_path, json.dumps(log_item) + "\n")
+            res = parse_explore_rsp(rsp, log_file=report_log_path)
+            act_name = res[0]
+            last_act = res[-1]
+            res = res[:-1]
+            if act_name == "FINISH":
+                task_complete = True
                 break
-        elif act_name == "text":
-            _, input_str = res
+            if act_name == "tap":
+                _, area = res
+                tl, br = elem_list.bbox(area - 1)
+                x, y = elem_list.center(area - 1)
+
+                # Draw a bounding box on the canvas image and save it
+                screenshot_before_actioned = controller.get_screenshot_with_bbox(screenshot_before, tl, br)
+                controller.draw_circle(x, y, screenshot_before_actioned)
+                artifacts.save_image(os.path.join(task_dir, f"{round_count}_before_labeled_action.png"),
+                                     screenshot_before_actioned)
+
+                ret = controller.tap(x, y)
+                if ret == "ERROR":
+                    print_with_color("ERROR: tap execution failed", "red")
+                    break
+            elif act_name == "text":
+                _, input_str = res
+
+                # Draw a bounding box on the canvas image and save it
+                screenshot_before_actioned = controller.get_screenshot_with_bbox(screenshot_before, tl, br)
+                artifacts.save_image(os.path.join(task_dir, f"{round_count}_before_labeled_action.png"),
+                                     screenshot_before_actioned)
+
+
+                ret = controller.text(input_str)
+                if ret == "ERROR":
+                    print_with_color("ERROR: text execution failed", "red")
+                    break
+            elif act_name == "long_press":
+                _, area = res
+                tl, br = elem_list.bbox(area - 1)
+                x, y = elem_list.center(area - 1)
+
+                # Draw a bounding box on the canvas image and save it
+                screenshot_before_actioned = controller.get_screenshot_with_bbox(screenshot_before, tl, br)
+                controller.draw_circle(x, y, screenshot_before_actioned)
+                artifacts.save_image(os.path.join(task_dir, f"{round_count}_before_labeled_action.png"),
+                                     screenshot_before_actioned)
+
+                ret = controller.long_press(x, y)
+                if ret == "ERROR":
+                    print_with_color("ERROR: long press execution failed", "red")
+                    break
+            elif act_name == "swipe":
+                _, area, swipe_dir, dist = res
+                tl, br = elem_list.bbox(area - 1)
+                x, y = elem_list.center(area - 1)
+
+                # Draw a bounding box on the canvas image and save it
+                screenshot_before_actioned = controller.get_screenshot_with_bbox(screenshot_before, tl, br)
+                controller.draw_arrow(x, y, swipe_dir, dist, screenshot_before_actioned)
+                artifacts.save_image(os.path.join(task_dir, f"{round_count}_before_labeled_action.png"),
+                                     screenshot_before_actioned)
+
+                ret = controller.swipe(x, y, swipe_dir, dist)
+                if ret == "ERROR":
+                    print_with_color("ERROR: swipe execution failed", "red")
+                    break
+            else:
+                break
+            controller.wait_for_settle()
 
-            # Draw a bounding box on the canvas image and save it
-            screenshot_before_actioned = os.path.join(task_dir, f"{round_count}_before_labeled_action.png")
-            controller.get_screenshot_with_bbox(screenshot_before, screenshot_before_actioned, tl, br)
+            # Add the actioned image to the report markdown file
+            append_to_log(
+                f"![Before action labeled action](./{round_count}_before_labeled_action.png)",
+                report_log_path,
+            )
+        else:
+            print_with_color(rsp, "red")
+            break
 
+        # The hierarchy is dumped alongside the screenshot, so the reflection also learns what the action changed in the
+        # UI structure. The next round reuses the dump when the screen stays the same.
+        state_after = controller.capture_state(f"{round_count}_after", task_dir, ("clickable", "focusable"), True,
+                                               useless_list, previous=state)
+        screenshot_after = state_after.frame
+        if screenshot_after == "ERROR":
+            break
+        action_diff = diff_nodes(state.nodes, state_after.nodes) if state_after.ok else None
+        state = state_after
+        base64_img_after = draw_bbox_multi(screenshot_after, os.path.join(task_dir, f"{round_count}_after_labeled.png"),
+                                           elem_list, dark_mode=configs["DARK_MODE"], scale=controller.label_scale)
 
-            ret = controller.text(input_str)
-            if ret == "ERROR":
-                print_with_color("ERROR: text execution failed", "red")
-                break
+        if act_name == "tap":
+            prompt = re.sub(r"<action>", "tapping", prompts.self_explore_reflect_with_persona_template)
+        elif act_name == "text":
+            continue
         elif act_name == "long_press":
-            _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-
-            # Draw a bounding box on the canvas image and save it
-            screenshot_before_actioned = os.path.join(task_dir, f"{round_count}_before_labeled_action.png")
-            controller.get_screenshot_with_bbox(screenshot_before, screenshot_before_actioned, tl, br)
-            controller.draw_circle(x, y, screenshot_before_actioned)
-
-            ret = controller.long_press(x, y)
-            if ret == "ERROR":
-                print_with_color("ERROR: long press execution failed", "red")
-                break
+            prompt = re.sub(r"<action>", "long pressing", prompts.self_explore_reflect_with_persona_template)
         elif act_name == "swipe":
-            _, area, swipe_dir, dist = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-
-            # Draw a bounding box on the canvas image and save it
-            screenshot_before_actioned = os.path.join(task_dir, f"{round_count}_before_labeled_action.png")
-            controller.get_screenshot_with_bbox(screenshot_before, screenshot_before_actioned, tl, br)
-            controller.draw_arrow(x, y, swipe_dir, dist, screenshot_before_actioned)
-
-            ret = controller.swipe(x, y, swipe_dir, dist)
-            if ret == "ERROR":
-                print_with_color("ERROR: swipe execution failed", "red")
-                break
+            swipe_dir = res[2]
+            if swipe_dir == "up" or swipe_dir == "down":
+                act_name = "v_swipe"
+            elif swipe_dir == "left" or swipe_dir == "right":
+                act_name = "h_swipe"
+            prompt = re.sub(r"<action>", "swiping", prompts.self_explore_reflect_with_persona_template)
         else:
+            print_with_color("ERROR: Undefined act!", "red")
             break
-        time.sleep(configs["REQUEST_INTERVAL"])
-
-        # Add the actioned image to the report markdown file
-        append_to_log(
-            f"![Before action labeled action](./{round_count}_before_labeled_action.png)",
-            report_log_path,
-        )
-    else:
-        print_with_color(rsp, "red")
-        break
-
-    screenshot_after = controller.get_screenshot(f"{round_count}_after", task_dir)
-    if screenshot_after == "ERROR":
-        break
-    draw_bbox_multi(screenshot_after, os.path.join(task_dir, f"{round_count}_after_labeled.png"), elem_list,
-                    dark_mode=configs["DARK_MODE"])
-    base64_img_after = os.path.join(task_dir, f"{round_count}_after_labeled.png")
-
-    if act_name == "tap":
-        prompt = re.sub(r"<action>", "tapping", prompts.self_explore_reflect_with_persona_template)
-    elif act_name == "text":
-        continue
-    elif act_name == "long_press":
-        prompt = re.sub(r"<action>", "long pressing", prompts.self_explore_reflect_with_persona_template)
-    elif act_name == "swipe":
-        swipe_dir = res[2]
-        if swipe_dir == "up" or swipe_dir == "down":
-            act_name = "v_swipe"
-        elif swipe_dir == "left" or swipe_dir == "right":
-            act_name = "h_swipe"
-        prompt = re.sub(r"<action>", "swiping", prompts.self_explore_reflect_with_persona_template)
-    else:
-        print_with_color("ERROR: Undefined act!", "red")
-        break
-    prompt = re.sub(r"<ui_element>", str(area), prompt)
-    prompt = re.sub(r"<task_desc>", task_desc, prompt)
-    prompt = re.sub(r"<last_act>", last_act, prompt)
-
-    print_with_color("Reflecting on my previous action...", "yellow")
-    status, rsp = mllm.get_model_response(prompt, [base64_img_before, base64_img_after])
-    if status:
-        resource_id = elem_list[int(area) - 1].uid
-        with open(reflect_log_path, "a") as logfile:
+        prompt = re.sub(r"<ui_element>", str(area), prompt)
+        prompt = re.sub(r"<task_desc>", task_desc, prompt)
+        prompt = re.sub(r"<last_act>", last_act, prompt)
+        ui_diff = ""
+        if action_diff is not None:
+            ui_diff = " For reference, the UI hierarchy changed as follows between the two screenshots: " \
+                      f"{action_diff.summary()}."
+        prompt = re.sub(r"<ui_diff>", ui_diff, prompt)
+
+        print_with_color("Reflecting on my previous action...", "yellow")
+        throttle.wait()
+        status, rsp = mllm.get_model_response(prompt, [base64_img_before, base64_img_after])
+        if status:
+            resource_id = elem_list.uids[int(area) - 1]
             log_item = {"step": round_count, "prompt": prompt, "image_before": f"{round_count}_before_labeled.png",
-                        "image_after": f"{round_count}_after.png", "response": rsp}
-            logfile.write(json.dumps(log_item) + "\n")
-        res = parse_reflect_rsp(rsp, log_file=report_log_path)
-        decision = res[0]
-        if decision == "ERROR":
-            break
-        if decision == "INEFFECTIVE":
-            useless_list.add(resource_id)
-            last_act = "None"
-        elif decision == "BACK" or decision == "CONTINUE" or decision == "SUCCESS":
-            if decision == "BACK" or decision == "CONTINUE":
+                        "image_after": f"{round_count}_after.png", "response": rsp,
+                        "ui_diff": action_diff.to_dict(limit=20) if action_diff is not None else None}
+            artifacts.append(reflect_log_path, json.dumps(log_item) + "\n")
+            res = parse_reflect_rsp(rsp, log_file=report_log_path)
+            decision = res[0]
+            if decision == "ERROR":
+                break
+            if decision == "INEFFECTIVE":
                 useless_list.add(resource_id)
                 last_act = "None"
-                if decision == "BACK":
-                    ret = controller.back()
-                    if ret == "ERROR":
-                        print_with_color("ERROR: back execution failed", "red")
-                        break
-            doc = res[-1]
-            doc_name = resource_id + ".txt"
-            doc_path = os.path.join(docs_dir, doc_name)
-            if os.path.exists(doc_path):
-                doc_content = ast.literal_eval(open(doc_path).read())
-                if doc_content[act_name]:
-                    print_with_color(f"Documentation for the element {resource_id} already exists.", "yellow")
-                    continue
+            elif decision == "BACK" or decision == "CONTINUE" or decision == "SUCCESS":
+                if decision == "BACK" or decision == "CONTINUE":
+                    useless_list.add(resource_id)
+                    last_act = "None"
+                    if decision == "BACK":
+                        ret = controller.back()
+                        if ret == "ERROR":
+                            print_with_color("ERROR: back execution failed", "red")
+                            break
+                doc = res[-1]
+                doc_name = resource_id + ".txt"
+                doc_path = os.path.join(docs_dir, doc_name)
+                if os.path.exists(doc_path):
+                    doc_content = ast.literal_eval(open(doc_path).read())
+                    if doc_content[act_name]:
+                        print_with_color(f"Documentation for the element {resource_id} already exists.", "yellow")
+                        continue
+                else:
+                    doc_content = {
+                        "tap": "",
+                        "text": "",
+                        "v_swipe": "",
+                        "h_swipe": "",
+                        "long_press": ""
+                    }
+                doc_content[act_name] = doc
+                with open(doc_path, "w") as outfile:
+                    outfile.write(str(doc_content))
+                doc_count += 1
+                print_with_color(f"Documentation generated and saved to {doc_path}", "yellow")
             else:
-                doc_content = {
-                    "tap": "",
-                    "text": "",
-                    "v_swipe": "",
-                    "h_swipe": "",
-                    "long_press": ""
-                }
-            doc_content[act_name] = doc
-            with open(doc_path, "w") as outfile:
-                outfile.write(str(doc_content))
-            doc_count += 1
-            print_with_color(f"Documentation generated and saved to {doc_path}", "yellow")
+                print_with_color(f"ERROR: Undefined decision! {decision}", "red")
+                break
         else:
-            print_with_color(f"ERROR: Undefined decision! {decision}", "red")
+            print_with_color(rsp["error"]["message"], "red")
             break
+        controller.wait_for_settle()
+
+    if task_complete:
+        print_with_color(f"Autonomous exploration completed successfully. {doc_count} docs generated.", "yellow")
+    elif round_count == configs["MAX_ROUNDS"]:
+        print_with_color(f"Autonomous exploration finished due to reaching max rounds. {doc_count} docs generated.",
+                         "yellow")
     else:
-        print_with_color(rsp["error"]["message"], "red")
-        break
-    time.sleep(configs["REQUEST_INTERVAL"])
-
-if task_complete:
-    print_with_color(f"Autonomous exploration completed successfully. {doc_count} docs generated.", "yellow")
-elif round_count == configs["MAX_ROUNDS"]:
-    print_with_color(f"Autonomous exploration finished due to reaching max rounds. {doc_count} docs generated.",
-                     "yellow")
-else:
-    print_with_color(f"Autonomous exploration finished unexpectedly. {doc_count} docs generated.", "red")
+        print_with_color(f"Autonomous exploration finished unexpectedly. {doc_count} docs generated.", "red")
+    print_with_color(f"Image cache: {image_cache.summary()}", "yellow")
+finally:
+    # Stops the frame stream, the hierarchy service forward and the shell session, and reports the adb metrics
+    controller.close()
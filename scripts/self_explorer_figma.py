@@ -9,7 +9,7 @@ import sys
 import ast
 
 from config import load_config
-from utils import print_with_color, draw_bbox_multi
+from utils import print_with_color, draw_bbox_multi, artifacts
 from urllib.parse import unquote
 from figma_controller import (
     SeleniumController,
@@ -209,6 +209,7 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
         useless_list = set()
         last_act = "None"
         task_complete = False
+        throttle = mllm.throttle
 
         # Write the report markdown file
         append_to_log(f"# User Testing Report for {app}", report_log_path)
@@ -241,9 +242,11 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                 heading_level=2,
             )
 
-            # Take a screenshot
+            # Take a screenshot and get the node data of the current node id from the URL
             screenshot_before = os.path.join(task_dir, f"{round_count}_before.png")
-            selenium_controller.take_screenshot(x, y, width, height, screenshot_before)
+            node_data = selenium_controller.capture_state(
+                x, y, width, height, screenshot_before, file["document"]["children"]
+            )
 
             screenshot_before_url = f"{round_count}_before.png"
 
@@ -253,10 +256,6 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                 break_line=False,
             )
 
-            # find Current node id from the URL and get its node data
-            current_node_id = selenium_controller.get_current_node_id()
-            node_data = find_node_by_id(current_node_id, file["document"]["children"])
-
             # Save the node data to the task directory
             node_data_path = os.path.join(task_dir, f"{round_count}.json")
             with open(node_data_path, "w") as f:
@@ -271,7 +270,7 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
 
             # Draw bounding boxes on the image
             output_path = os.path.join(task_dir, f"{round_count}_before_labeled.png")
-            draw_bbox_multi(
+            base64_img_before = draw_bbox_multi(
                 screenshot_before,
                 output_path,
                 elem_list,
@@ -293,21 +292,18 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                 prompts.self_explore_task_with_persona_template,
             )
             prompt = re.sub(r"<last_act>", last_act, prompt)
-            base64_img_before = os.path.join(
-                task_dir, f"{round_count}_before_labeled.png"
-            )
             print_with_color("Thinking about what to do in the next step...", "yellow")
+            throttle.wait()
             status, rsp = mllm.get_model_response(prompt, [base64_img_before])
 
             if status:
-                with open(explore_log_path, "a") as logfile:
-                    log_item = {
-                        "step": round_count,
-                        "prompt": prompt,
-                        "image": f"{round_count}_before_labeled.png",
-                        "response": rsp,
-                    }
-                    logfile.write(json.dumps(log_item) + "\n")
+                log_item = {
+                    "step": round_count,
+                    "prompt": prompt,
+                    "image": f"{round_count}_before_labeled.png",
+                    "response": rsp,
+                }
+                artifacts.append(explore_log_path, json.dumps(log_item) + "\n")
 
                 res = parse_explore_rsp(rsp, log_file=report_log_path)
                 act_name = res[0]
@@ -329,17 +325,22 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                     center_y += y
 
                     # Draw a bounding box on the canvas image and save it
-                    screenshot_before_actioned = os.path.join(
-                        task_dir, f"{round_count}_before_labeled_action.png"
-                    )
-                    selenium_controller.take_canvas_screenshot(
-                        screenshot_before, tl, br, screenshot_before_actioned
+                    screenshot_before_actioned = (
+                        selenium_controller.take_canvas_screenshot(
+                            screenshot_before, tl, br
+                        )
                     )
 
                     if act_name == "tap":
                         selenium_controller.draw_circle(
                             center_x, center_y, screenshot_before_actioned
                         )
+                        artifacts.save_image(
+                            os.path.join(
+                                task_dir, f"{round_count}_before_labeled_action.png"
+                            ),
+                            screenshot_before_actioned,
+                        )
                         ret = selenium_controller.tap(center_x, center_y)
                         if ret == "ERROR":
                             print_with_color("ERROR: tap execution failed", "red")
@@ -348,6 +349,12 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                         selenium_controller.draw_circle(
                             center_x, center_y, screenshot_before_actioned
                         )
+                        artifacts.save_image(
+                            os.path.join(
+                                task_dir, f"{round_count}_before_labeled_action.png"
+                            ),
+                            screenshot_before_actioned,
+                        )
                         ret = selenium_controller.long_press(center_x, center_y)
                         if ret == "ERROR":
                             print_with_color(
@@ -363,6 +370,12 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                             dist,
                             screenshot_before_actioned,
                         )
+                        artifacts.save_image(
+                            os.path.join(
+                                task_dir, f"{round_count}_before_labeled_action.png"
+                            ),
+                            screenshot_before_actioned,
+                        )
                         ret = selenium_controller.swipe(
                             center_x, center_y, swipe_dir, dist
                         )
@@ -381,7 +394,11 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                     )
                 else:
                     break
-                time.sleep(configs["REQUEST_INTERVAL"])
+                selenium_controller.wait_for_settle(
+                    configs["SETTLE_TIMEOUT"],
+                    configs["SETTLE_INTERVAL"],
+                    configs["SETTLE_SAMPLES"],
+                )
             else:
                 print_with_color(rsp, "red")
                 break
@@ -390,7 +407,7 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
             screenshot_after = os.path.join(task_dir, f"{round_count}_after.png")
             selenium_controller.take_screenshot(x, y, width, height, screenshot_after)
 
-            draw_bbox_multi(
+            base64_img_after = draw_bbox_multi(
                 screenshot_after,
                 os.path.join(task_dir, f"{round_count}_after_labeled.png"),
                 elem_list,
@@ -399,10 +416,6 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                 dark_mode=configs["DARK_MODE"],
             )
 
-            base64_img_after = os.path.join(
-                task_dir, f"{round_count}_after_labeled.png"
-            )
-
             if act_name == "tap":
                 prompt = re.sub(
                     r"<action>",
@@ -434,23 +447,24 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
             prompt = re.sub(r"<ui_element>", str(area), prompt)
             prompt = re.sub(r"<task_desc>", task_desc, prompt)
             prompt = re.sub(r"<last_act>", last_act, prompt)
+            prompt = re.sub(r"<ui_diff>", "", prompt)
 
             print_with_color("Reflecting on my previous action...", "yellow")
+            throttle.wait()
             status, rsp = mllm.get_model_response(
                 prompt, [base64_img_before, base64_img_after]
             )
 
             if status:
                 resource_id = elem_list[int(area) - 1].uid
-                with open(reflect_log_path, "a") as logfile:
-                    log_item = {
-                        "step": round_count,
-                        "prompt": prompt,
-                        "image_before": f"{round_count}_before_labeled.png",
-                        "image_after": f"{round_count}_after.png",
-                        "response": rsp,
-                    }
-                    logfile.write(json.dumps(log_item) + "\n")
+                log_item = {
+                    "step": round_count,
+                    "prompt": prompt,
+                    "image_before": f"{round_count}_before_labeled.png",
+                    "image_after": f"{round_count}_after.png",
+                    "response": rsp,
+                }
+                artifacts.append(reflect_log_path, json.dumps(log_item) + "\n")
                 res = parse_reflect_rsp(rsp, log_file=report_log_path)
                 decision = res[0]
                 if decision == "ERROR":
@@ -504,7 +518,11 @@ def run_exploration(init_data, task_desc, persona_desc, stop_event=None, server=
                 print_with_color(rsp["error"]["message"], "red")
                 break
 
-            time.sleep(configs["REQUEST_INTERVAL"])
+            selenium_controller.wait_for_settle(
+                configs["SETTLE_TIMEOUT"],
+                configs["SETTLE_INTERVAL"],
+                configs["SETTLE_SAMPLES"],
+            )
 
         if task_complete:
             print_with_color(
@@ -7,6 +7,8 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import threading
+from adb_client import cancel_all
+from utils import artifacts
 from self_explorer_figma import init_exploration, run_exploration
 
 app = Flask(__name__)
@@ -79,11 +81,15 @@ def stop_exploration():
 
     try:
         stop_event.set()
+        # Abort adb commands that are still in flight instead of waiting for them to return
+        cancel_all()
 
         if exploration_thread and exploration_thread.is_alive():
             exploration_thread.join(timeout=10)
             if exploration_thread.is_alive():
                 raise TimeoutError("Exploration thread did not terminate in time")
+        # Make sure the report and the screenshots of the last round are on disk
+        artifacts.flush()
 
         if init_data and "selenium_controller" in init_data:
             try:
@@ -129,6 +135,7 @@ def get_report():
     if not init_data or "report_log_path" not in init_data:
         return jsonify({"status": "error", "message": "Report not available"}), 404
     
+    artifacts.flush()
     report_path = init_data["report_log_path"]
     if not os.path.exists(report_path):
         return jsonify({"status": "error", "message": "Report file not found"}), 404
@@ -141,6 +148,7 @@ def get_report():
 @app.route('/get_image', methods=['POST'])
 def get_image():
     file_path = request.json['file_path']
+    artifacts.flush()
     full_path = os.path.join(init_data['task_dir'], file_path)
 
     if os.path.exists(full_path):
@@ -5,18 +5,23 @@ import json
 import os
 import re
 import sys
+import threading
 import time
 
 import prompts
 from config import load_config
-from and_controller import list_all_devices, AndroidController, traverse_tree
+from and_controller import list_all_devices, AndroidController, HierarchyDiffer
+from fleet import run_fleet
 from model import parse_explore_rsp, parse_grid_rsp, OpenAIModel, QwenModel
-from utils import print_with_color, draw_bbox_multi, draw_grid
+from utils import print_with_color, draw_bbox_multi, draw_grid, grid_points, GRID_SUBAREAS, artifacts
 
 arg_desc = "AppAgent Executor"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
 parser.add_argument("--app")
 parser.add_argument("--root_dir", default="./")
+parser.add_argument("--devices", help="Comma separated device IDs, or \"all\", to run a queue of tasks on several "
+                                      "devices at once")
+parser.add_argument("--task_file", help="File with one task description per line, used with --devices")
 args = vars(parser.parse_args())
 
 configs = load_config()
@@ -49,12 +54,9 @@ if not os.path.exists(work_dir):
 auto_docs_dir = os.path.join(app_dir, "auto_docs")
 demo_docs_dir = os.path.join(app_dir, "demo_docs")
 task_timestamp = int(time.time())
-dir_name = datetime.datetime.fromtimestamp(task_timestamp).strftime(f"task_{app}_%Y-%m-%d_%H-%M-%S")
-task_dir = os.path.join(work_dir, dir_name)
-os.mkdir(task_dir)
-log_path = os.path.join(task_dir, f"log_{app}_{dir_name}.txt")
 
 no_doc = False
+docs_dir = None
 if not os.path.exists(auto_docs_dir) and not os.path.exists(demo_docs_dir):
     print_with_color(f"No documentations found for the app {app}. Do you want to proceed with no docs? Enter y or n",
                      "red")
@@ -86,206 +88,241 @@ else:
                      f"selected automatically.", "yellow")
     docs_dir = demo_docs_dir
 
-device_list = list_all_devices()
-if not device_list:
-    print_with_color("ERROR: No device found!", "red")
-    sys.exit()
-print_with_color(f"List of devices attached:\n{str(device_list)}", "yellow")
-if len(device_list) == 1:
-    device = device_list[0]
-    print_with_color(f"Device selected: {device}", "yellow")
-else:
-    print_with_color("Please choose the Android device to start demo by entering its ID:", "blue")
-    device = input()
-controller = AndroidController(device)
-width, height = controller.get_device_size()
-if not width and not height:
-    print_with_color("ERROR: Invalid device size!", "red")
-    sys.exit()
-print_with_color(f"Screen resolution of {device}: {width}x{height}", "yellow")
 
-print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
-task_desc = input()
+def make_task_dir(suffix=""):
+    dir_name = datetime.datetime.fromtimestamp(task_timestamp).strftime(f"task_{app}_%Y-%m-%d_%H-%M-%S") + suffix
+    task_dir = os.path.join(work_dir, dir_name)
+    os.mkdir(task_dir)
+    return dir_name, task_dir
 
-round_count = 0
-last_act = "None"
-task_complete = False
-grid_on = False
-rows, cols = 0, 0
 
+doc_cache = {}
+doc_cache_lock = threading.Lock()
 
-def area_to_xy(area, subarea):
-    area -= 1
-    row, col = area // cols, area % cols
-    x_0, y_0 = col * (width // cols), row * (height // rows)
-    if subarea == "top-left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) // 4
-    elif subarea == "top":
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) // 4
-    elif subarea == "top-right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) // 4
-    elif subarea == "left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) // 2
-    elif subarea == "right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) // 2
-    elif subarea == "bottom-left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) * 3 // 4
-    elif subarea == "bottom":
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) * 3 // 4
-    elif subarea == "bottom-right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) * 3 // 4
-    else:
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) // 2
-    return x, y
 
+def load_doc(doc_path):
+    # Docs do not change while tasks are executed, so each one is read and parsed at most once, even across devices
+    with doc_cache_lock:
+        if doc_path not in doc_cache:
+            if os.path.exists(doc_path):
+                doc_cache[doc_path] = ast.literal_eval(open(doc_path, "r").read())
+            else:
+                doc_cache[doc_path] = None
+        return doc_cache[doc_path]
 
-while round_count < configs["MAX_ROUNDS"]:
-    round_count += 1
-    print_with_color(f"Round {round_count}", "yellow")
-    screenshot_path = controller.get_screenshot(f"{dir_name}_{round_count}", task_dir)
-    xml_path = controller.get_xml(f"{dir_name}_{round_count}", task_dir)
-    if screenshot_path == "ERROR" or xml_path == "ERROR":
-        break
-    if grid_on:
-        rows, cols = draw_grid(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"))
-        image = os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png")
-        prompt = prompts.task_template_grid
-    else:
-        clickable_list = []
-        focusable_list = []
-        traverse_tree(xml_path, clickable_list, "clickable", True)
-        traverse_tree(xml_path, focusable_list, "focusable", True)
-        elem_list = clickable_list.copy()
-        for elem in focusable_list:
-            bbox = elem.bbox
-            center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-            close = False
-            for e in clickable_list:
-                bbox = e.bbox
-                center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-                dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-                if dist <= configs["MIN_DIST"]:
-                    close = True
-                    break
-            if not close:
-                elem_list.append(elem)
-        draw_bbox_multi(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"), elem_list,
-                        dark_mode=configs["DARK_MODE"])
-        image = os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png")
-        if no_doc:
-            prompt = re.sub(r"<ui_document>", "", prompts.task_template)
+
+def area_to_xy(area, subarea, rows, cols, width, height):
+    points = grid_points(rows, cols, width, height)
+    if not 1 <= area <= len(points):
+        print_with_color(f"ERROR: grid area {area} is out of range, using the nearest one", "red")
+        area = min(max(area, 1), len(points))
+    subarea = GRID_SUBAREAS.index(subarea if subarea in GRID_SUBAREAS else "center")
+    x, y = points[area - 1, subarea]
+    return int(x), int(y)
+
+
+def run_task(controller, task_desc, dir_name, task_dir, log_prefix=""):
+    log_path = os.path.join(task_dir, f"log_{app}_{dir_name}.txt")
+    round_count = 0
+    last_act = "None"
+    task_complete = False
+    throttle = mllm.throttle
+    grid_on = False
+    rows, cols = 0, 0
+    differ = HierarchyDiffer()
+    ui_doc = None
+    state = None
+
+    while round_count < configs["MAX_ROUNDS"]:
+        round_count += 1
+        print_with_color(f"{log_prefix}Round {round_count}", "yellow")
+        state = controller.capture_state(f"{dir_name}_{round_count}", task_dir, ("clickable", "focusable"), True,
+                                         previous=state)
+        if not state.ok:
+            break
+        screenshot_path, elem_list = state.frame, state.elem_list
+        ui_diff = differ.update(state.nodes)
+        if round_count > 1:
+            if ui_diff.changed:
+                print_with_color(f"UI changes since the last round: {ui_diff.summary()}", "yellow")
+            else:
+                print_with_color("The UI hierarchy did not change since the last round", "yellow")
+        if grid_on:
+            rows, cols, image = draw_grid(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"))
+            prompt = prompts.task_template_grid
+            ui_doc = None
         else:
-            ui_doc = ""
-            for i, elem in enumerate(elem_list):
-                doc_path = os.path.join(docs_dir, f"{elem.uid}.txt")
-                if not os.path.exists(doc_path):
-                    continue
-                ui_doc += f"Documentation of UI element labeled with the numeric tag '{i + 1}':\n"
-                doc_content = ast.literal_eval(open(doc_path, "r").read())
-                if doc_content["tap"]:
-                    ui_doc += f"This UI element is clickable. {doc_content['tap']}\n\n"
-                if doc_content["text"]:
-                    ui_doc += f"This UI element can receive text input. The text input is used for the following " \
-                              f"purposes: {doc_content['text']}\n\n"
-                if doc_content["long_press"]:
-                    ui_doc += f"This UI element is long clickable. {doc_content['long_press']}\n\n"
-                if doc_content["v_swipe"]:
-                    ui_doc += f"This element can be swiped directly without tapping. You can swipe vertically on " \
-                              f"this UI element. {doc_content['v_swipe']}\n\n"
-                if doc_content["h_swipe"]:
-                    ui_doc += f"This element can be swiped directly without tapping. You can swipe horizontally on " \
-                              f"this UI element. {doc_content['h_swipe']}\n\n"
-            print_with_color(f"Documentations retrieved for the current interface:\n{ui_doc}", "magenta")
-            ui_doc = """
+            image = draw_bbox_multi(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"),
+                                    elem_list, dark_mode=configs["DARK_MODE"], scale=controller.label_scale)
+            if no_doc:
+                prompt = re.sub(r"<ui_document>", "", prompts.task_template)
+            else:
+                if ui_diff.changed or ui_doc is None:
+                    ui_doc = ""
+                    for i, uid in enumerate(elem_list.uids):
+                        doc_content = load_doc(os.path.join(docs_dir, f"{uid}.txt"))
+                        if doc_content is None:
+                            continue
+                        ui_doc += f"Documentation of UI element labeled with the numeric tag '{i + 1}':\n"
+                        if doc_content["tap"]:
+                            ui_doc += f"This UI element is clickable. {doc_content['tap']}\n\n"
+                        if doc_content["text"]:
+                            ui_doc += f"This UI element can receive text input. The text input is used for the " \
+                                      f"following purposes: {doc_content['text']}\n\n"
+                        if doc_content["long_press"]:
+                            ui_doc += f"This UI element is long clickable. {doc_content['long_press']}\n\n"
+                        if doc_content["v_swipe"]:
+                            ui_doc += f"This element can be swiped directly without tapping. You can swipe " \
+                                      f"vertically on this UI element. {doc_content['v_swipe']}\n\n"
+                        if doc_content["h_swipe"]:
+                            ui_doc += f"This element can be swiped directly without tapping. You can swipe " \
+                                      f"horizontally on this UI element. {doc_content['h_swipe']}\n\n"
+                    print_with_color(f"Documentations retrieved for the current interface:\n{ui_doc}", "magenta")
+                    ui_doc = """
             You also have access to the following documentations that describes the functionalities of UI 
             elements you can interact on the screen. These docs are crucial for you to determine the target of your 
             next action. You should always prioritize these documented elements for interaction:""" + ui_doc
-            prompt = re.sub(r"<ui_document>", ui_doc, prompts.task_template)
-    prompt = re.sub(r"<task_description>", task_desc, prompt)
-    prompt = re.sub(r"<last_act>", last_act, prompt)
-    print_with_color("Thinking about what to do in the next step...", "yellow")
-    status, rsp = mllm.get_model_response(prompt, [image])
+                else:
+                    print_with_color("Reusing the documentations of the last round as the UI did not change", "magenta")
+                prompt = re.sub(r"<ui_document>", ui_doc, prompts.task_template)
+        prompt = re.sub(r"<task_description>", task_desc, prompt)
+        prompt = re.sub(r"<last_act>", last_act, prompt)
+        print_with_color("Thinking about what to do in the next step...", "yellow")
+        throttle.wait()
+        status, rsp = mllm.get_model_response(prompt, [image])
 
-    if status:
-        with open(log_path, "a") as logfile:
+        if status:
             log_item = {"step": round_count, "prompt": prompt, "image": f"{dir_name}_{round_count}_labeled.png",
-                        "response": rsp}
-            logfile.write(json.dumps(log_item) + "\n")
-        if grid_on:
-            res = parse_grid_rsp(rsp)
-        else:
-            res = parse_explore_rsp(rsp)
-        act_name = res[0]
-        if act_name == "FINISH":
-            task_complete = True
-            break
-        if act_name == "ERROR":
-            break
-        last_act = res[-1]
-        res = res[:-1]
-        if act_name == "tap":
-            _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-            ret = controller.tap(x, y)
-            if ret == "ERROR":
-                print_with_color("ERROR: tap execution failed", "red")
-                break
-        elif act_name == "text":
-            _, input_str = res
-            ret = controller.text(input_str)
-            if ret == "ERROR":
-                print_with_color("ERROR: text execution failed", "red")
-                break
-        elif act_name == "long_press":
-            _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-            ret = controller.long_press(x, y)
-            if ret == "ERROR":
-                print_with_color("ERROR: long press execution failed", "red")
+                        "response": rsp, "ui_diff": ui_diff.to_dict(limit=20)}
+            artifacts.append(log_path, json.dumps(log_item) + "\n")
+            if grid_on:
+                res = parse_grid_rsp(rsp)
+            else:
+                res = parse_explore_rsp(rsp)
+            act_name = res[0]
+            if act_name == "FINISH":
+                task_complete = True
                 break
-        elif act_name == "swipe":
-            _, area, swipe_dir, dist = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
-            ret = controller.swipe(x, y, swipe_dir, dist)
-            if ret == "ERROR":
-                print_with_color("ERROR: swipe execution failed", "red")
+            if act_name == "ERROR":
                 break
-        elif act_name == "grid":
-            grid_on = True
-        elif act_name == "tap_grid" or act_name == "long_press_grid":
-            _, area, subarea = res
-            x, y = area_to_xy(area, subarea)
-            if act_name == "tap_grid":
+            last_act = res[-1]
+            res = res[:-1]
+            if act_name == "tap":
+                _, area = res
+                x, y = elem_list.center(area - 1)
                 ret = controller.tap(x, y)
                 if ret == "ERROR":
-                    print_with_color("ERROR: tap execution failed", "red")
+                    print_with_color(f"{log_prefix}ERROR: tap execution failed", "red")
                     break
-            else:
+            elif act_name == "text":
+                _, input_str = res
+                ret = controller.text(input_str)
+                if ret == "ERROR":
+                    print_with_color(f"{log_prefix}ERROR: text execution failed", "red")
+                    break
+            elif act_name == "long_press":
+                _, area = res
+                x, y = elem_list.center(area - 1)
                 ret = controller.long_press(x, y)
                 if ret == "ERROR":
-                    print_with_color("ERROR: tap execution failed", "red")
+                    print_with_color(f"{log_prefix}ERROR: long press execution failed", "red")
                     break
-        elif act_name == "swipe_grid":
-            _, start_area, start_subarea, end_area, end_subarea = res
-            start_x, start_y = area_to_xy(start_area, start_subarea)
-            end_x, end_y = area_to_xy(end_area, end_subarea)
-            ret = controller.swipe_precise((start_x, start_y), (end_x, end_y))
-            if ret == "ERROR":
-                print_with_color("ERROR: tap execution failed", "red")
-                break
-        if act_name != "grid":
-            grid_on = False
-        time.sleep(configs["REQUEST_INTERVAL"])
+            elif act_name == "swipe":
+                _, area, swipe_dir, dist = res
+                x, y = elem_list.center(area - 1)
+                ret = controller.swipe(x, y, swipe_dir, dist)
+                if ret == "ERROR":
+                    print_with_color(f"{log_prefix}ERROR: swipe execution failed", "red")
+                    break
+            elif act_name == "grid":
+                grid_on = True
+            elif act_name == "tap_grid" or act_name == "long_press_grid":
+                _, area, subarea = res
+                x, y = area_to_xy(area, subarea, rows, cols, controller.width, controller.height)
+                if act_name == "tap_grid":
+                    ret = controller.tap(x, y)
+                    if ret == "ERROR":
+                        print_with_color(f"{log_prefix}ERROR: tap execution failed", "red")
+                        break
+                else:
+                    ret = controller.long_press(x, y)
+                    if ret == "ERROR":
+                        print_with_color(f"{log_prefix}ERROR: tap execution failed", "red")
+                        break
+            elif act_name == "swipe_grid":
+                _, start_area, start_subarea, end_area, end_subarea = res
+                start_x, start_y = area_to_xy(start_area, start_subarea, rows, cols, controller.width,
+                                              controller.height)
+                end_x, end_y = area_to_xy(end_area, end_subarea, rows, cols, controller.width, controller.height)
+                ret = controller.swipe_precise((start_x, start_y), (end_x, end_y))
+                if ret == "ERROR":
+                    print_with_color(f"{log_prefix}ERROR: tap execution failed", "red")
+                    break
+            if act_name != "grid":
+                grid_on = False
+            controller.wait_for_settle()
+        else:
+            print_with_color(rsp, "red")
+            break
+
+    if task_complete:
+        print_with_color(f"{log_prefix}Task completed successfully", "yellow")
+        return "completed", round_count
+    elif round_count == configs["MAX_ROUNDS"]:
+        print_with_color(f"{log_prefix}Task finished due to reaching max rounds", "yellow")
+        return "max_rounds", round_count
     else:
-        print_with_color(rsp, "red")
-        break
+        print_with_color(f"{log_prefix}Task finished unexpectedly", "red")
+        return "error", round_count
+
+
+def run_fleet_task(controller, task_index, task_desc):
+    dir_name, task_dir = make_task_dir(f"_{task_index + 1}")
+    return run_task(controller, task_desc, dir_name, task_dir, f"[{controller.device}] ")
+
 
-if task_complete:
-    print_with_color("Task completed successfully", "yellow")
-elif round_count == configs["MAX_ROUNDS"]:
-    print_with_color("Task finished due to reaching max rounds", "yellow")
+device_list = list_all_devices()
+if not device_list:
+    print_with_color("ERROR: No device found!", "red")
+    sys.exit()
+print_with_color(f"List of devices attached:\n{str(device_list)}", "yellow")
+
+if args["devices"]:
+    if args["devices"] == "all":
+        devices = device_list
+    else:
+        devices = [device.strip() for device in args["devices"].split(",") if device.strip()]
+    missing = [device for device in devices if device not in device_list]
+    if missing:
+        print_with_color(f"ERROR: Devices not attached: {', '.join(missing)}", "red")
+        sys.exit()
+    if not args["task_file"]:
+        print_with_color("ERROR: --task_file is required when running on several devices!", "red")
+        sys.exit()
+    with open(args["task_file"], "r") as f:
+        tasks = [line.strip() for line in f if line.strip()]
+    print_with_color(f"Running {len(tasks)} tasks on {len(devices)} devices", "yellow")
+    run_fleet(devices, tasks, run_fleet_task)
+    sys.exit()
+
+if len(device_list) == 1:
+    device = device_list[0]
+    print_with_color(f"Device selected: {device}", "yellow")
 else:
-    print_with_color("Task finished unexpectedly", "red")
+    print_with_color("Please choose the Android device to start demo by entering its ID:", "blue")
+    device = input()
+controller = AndroidController(device)
+try:
+    width, height = controller.width, controller.height
+    if not width and not height:
+        print_with_color("ERROR: Invalid device size!", "red")
+        sys.exit()
+    print_with_color(f"Screen resolution of {device}: {width}x{height}", "yellow")
+
+    print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
+    task_desc = input()
+
+    dir_name, task_dir = make_task_dir()
+    run_task(controller, task_desc, dir_name, task_dir)
+finally:
+    controller.close()
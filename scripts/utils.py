@@ -1,6 +1,14 @@
+import atexit
 import base64
+import collections
+import hashlib
+import queue
+import struct
+import threading
+import time
+
 import cv2
-import pyshine as ps
+import numpy as np
 
 from colorama import Fore, Style
 
@@ -31,14 +39,180 @@ def print_with_color(text: str, color="", log_file=None, heading_level=None):
         # If a heading level is specified, prepend the message with the appropriate number of '#'
         if heading_level is not None:
             text = '#' * heading_level + ' ' + text
-        with open(log_file, "a") as f:
-            f.write(text + "\n")
+        artifacts.append(log_file, text + "\n")
+
+
+# Pixel formats of the raw "screencap" output that can be wrapped without decoding, mapped to the OpenCV conversion
+# into BGR. 1 = RGBA_8888, 2 = RGBX_8888, 5 = BGRA_8888.
+RAW_PIXEL_FORMATS = {1: cv2.COLOR_RGBA2BGR, 2: cv2.COLOR_RGBA2BGR, 5: cv2.COLOR_BGRA2BGR}
+
+
+def raw_format_supported(buf):
+    # Only a header that names a pixel format we cannot wrap says so for good, a short or cut off capture may be a
+    # one-off transfer error
+    return len(buf) < 12 or struct.unpack_from("<III", buf)[2] in RAW_PIXEL_FORMATS
+
+
+class Frame:
+    def __init__(self, image=None, data=None, path=None, ext=".png"):
+        self._image = image
+        self._data = data
+        self.path = path
+        self.ext = ext
+        self.raw = None
+        self.raw_format = None
+
+    @classmethod
+    def from_raw(cls, buf):
+        # The header is width, height and pixel format, followed by a colour space field since Android 9.
+        if len(buf) < 12:
+            return None
+        width, height, pixel_format = struct.unpack_from("<III", buf)
+        header_size = len(buf) - width * height * 4
+        if header_size not in (12, 16) or pixel_format not in RAW_PIXEL_FORMATS:
+            return None
+        frame = cls()
+        frame.raw = np.frombuffer(buf, np.uint8, width * height * 4, header_size).reshape(height, width, 4)
+        frame.raw_format = pixel_format
+        return frame
+
+    @property
+    def size(self):
+        # Width and height, read from the header instead of decoding the image where possible
+        if self.raw is not None:
+            return self.raw.shape[1], self.raw.shape[0]
+        if self._image is None and self._data is not None and self._data[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", self._data[16:24])
+        return self.image.shape[1], self.image.shape[0]
+
+    @property
+    def decoded(self):
+        # Whether the pixels are held in memory, either decoded or as raw framebuffer data
+        return self._image is not None or self.raw is not None
+
+    def copy_image(self):
+        # Converting the raw pixels already produces a new array, so there is no need to copy it a second time
+        if self._image is None and self.raw is not None:
+            return cv2.cvtColor(self.raw, RAW_PIXEL_FORMATS[self.raw_format])
+        return self.image.copy()
+
+    @property
+    def image(self):
+        if self._image is None:
+            if self.raw is not None:
+                self._image = cv2.cvtColor(self.raw, RAW_PIXEL_FORMATS[self.raw_format])
+            elif self._data is None:
+                self._image = cv2.imread(self.path)
+            else:
+                self._image = cv2.imdecode(np.frombuffer(self._data, np.uint8), cv2.IMREAD_COLOR)
+        return self._image
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self._image is None and self.raw is None:
+                with open(self.path, "rb") as f:
+                    self._data = f.read()
+            else:
+                _, buf = cv2.imencode(self.ext, self.image)
+                self._data = buf.tobytes()
+        return self._data
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.data)
+        self.path = path
+        return path
+
+
+def frame_signature(frame, size=(32, 64)):
+    # Hash of a heavily downscaled and quantised frame. Small rendering noise does not change it, any visible change of
+    # the layout does.
+    if isinstance(frame, Frame):
+        img = frame.raw if frame.raw is not None else frame.image
+    else:
+        img = frame
+    if img is None:
+        return None
+    small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return hashlib.sha1((small >> 4).tobytes()).hexdigest()
+
+
+def wait_until_stable(sample, timeout, interval, stable_samples):
+    # Poll sample() until it returns the same non-empty value stable_samples times in a row or the timeout expires
+    deadline = time.time() + timeout
+    last = None
+    count = 0
+    while True:
+        value = sample()
+        if value is not None and value == last:
+            count += 1
+        else:
+            count = 1 if value is not None else 0
+        last = value
+        if count >= stable_samples:
+            return True
+        if time.time() + interval > deadline:
+            return False
+        time.sleep(interval)
+
+
+class RequestThrottle:
+    # Shared by every thread that sends requests through the same model client. The interval applies to each thread on
+    # its own, so the devices of a fleet, one worker thread each, are paced independently and still query the model
+    # at the same time. It is a per device interval, not a limit for the provider as a whole: N devices send up to N
+    # requests per interval.
+    def __init__(self, interval):
+        self.interval = interval
+        self.local = threading.local()
+
+    def wait(self):
+        # Only sleep for what is left of the interval since the previous request of the calling thread
+        now = time.time()
+        slot = max(now, getattr(self.local, "last_request", 0) + self.interval)
+        self.local.last_request = slot
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def read_image(img):
+    # Always hand out a private copy so that drawing on it never alters the captured frame
+    if isinstance(img, Frame):
+        return img.copy_image()
+    return cv2.imread(img)
+
 
+def draw_labels(image, labels, font_scale, space, thickness, alpha=0.5, font=cv2.FONT_HERSHEY_DUPLEX):
+    # Draws every label as text on a half transparent box, in place. Each label is (text, x, y, background, colour)
+    # with RGB colours and x, y the top left corner of the text. Only the pixels under a box are blended, straight into
+    # the image against one solid tile per background colour, so nothing is allocated per label.
+    height, width = image.shape[:2]
+    tiles = {}
+    for text, x, y, background, color in labels:
+        (text_width, text_height), _ = cv2.getTextSize(text, font, font_scale, thickness)
+        box = image[max(y - space, 0):min(y + text_height + space, height),
+                    max(x - space, 0):min(x + text_width + space, width)]
+        if box.size == 0:
+            continue
+        tile = tiles.get(background)
+        if tile is None or tile.shape[0] < box.shape[0] or tile.shape[1] < box.shape[1]:
+            tile = np.empty((max(box.shape[0], 64), max(box.shape[1], 256), 3), np.uint8)
+            tile[:] = background[::-1]
+            tiles[background] = tile
+        cv2.addWeighted(box, alpha, tile[:box.shape[0], :box.shape[1]], 1 - alpha, 0, dst=box)
+        cv2.putText(image, text, (x, y + text_height), font, font_scale, color[::-1], thickness)
+    return image
 
-def draw_bbox_multi(img_path, output_path, elem_list, device_width=None, device_height=None, record_mode=False, dark_mode=False):
-    imgcv = cv2.imread(img_path)
-    count = 1
-    if device_width and device_width <= 360:
+
+def draw_bbox_multi(img, output_path, elem_list, device_width=None, device_height=None, record_mode=False, dark_mode=False,
+                    scale=None):
+    imgcv = read_image(img)
+    if scale:
+        # Scale the labels with the pixel density of the device so that they keep the same physical size
+        font_scale = scale
+        space = max(1, round(10 * scale))
+        thickness = max(1, round(2 * scale))
+    elif device_width and device_width <= 360:
         font_scale = 0.5
         space = 5
         thickness = 1
@@ -46,70 +220,283 @@ def draw_bbox_multi(img_path, output_path, elem_list, device_width=None, device_
         font_scale = 1
         space = 10
         thickness = 2
-    for elem in elem_list:
-        try:
-            top_left = elem.bbox[0]
-            bottom_right = elem.bbox[1]
-            left, top = top_left[0], top_left[1]
-            right, bottom = bottom_right[0], bottom_right[1]
-            label = str(count)
-            if record_mode:
-                if elem.attrib == "clickable":
-                    color = (250, 0, 0)
-                elif elem.attrib == "focusable":
-                    color = (0, 0, 250)
-                else:
-                    color = (0, 250, 0)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=space, hspace=space, font_scale=font_scale, thickness=thickness, background_RGB=color,
-                                    text_RGB=(255, 250, 250), alpha=0.5)
+    # Element tables already carry their centres, plain element lists are converted on the fly
+    if hasattr(elem_list, "centers"):
+        centers = elem_list.centers.tolist()
+        attribs = [elem_list.attrib_names[i] for i in elem_list.attribs]
+    else:
+        centers = [((elem.bbox[0][0] + elem.bbox[1][0]) // 2, (elem.bbox[0][1] + elem.bbox[1][1]) // 2)
+                   for elem in elem_list]
+        attribs = [getattr(elem, "attrib", None) for elem in elem_list]
+    labels = []
+    for count, ((center_x, center_y), attrib) in enumerate(zip(centers, attribs), 1):
+        if record_mode:
+            if attrib == "clickable":
+                color = (250, 0, 0)
+            elif attrib == "focusable":
+                color = (0, 0, 250)
             else:
-                text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
-                bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=space, hspace=space, font_scale=font_scale, thickness=thickness, background_RGB=bg_color,
-                                    text_RGB=text_color, alpha=0.5)
-        except Exception as e:
-            print_with_color(f"ERROR: An exception occurs while labeling the image\n{e}", "red")
-        count += 1
-    cv2.imwrite(output_path, imgcv)
-    return imgcv
-
-def draw_grid(img_path, output_path):
-    def get_unit_len(n):
-        for i in range(1, n + 1):
-            if n % i == 0 and 120 <= i <= 180:
-                return i
-        return -1
-
-    image = cv2.imread(img_path)
+                color = (0, 250, 0)
+            labels.append((str(count), center_x + 10, center_y + 10, color, (255, 250, 250)))
+        else:
+            text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
+            bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
+            labels.append((str(count), center_x + 10, center_y + 10, bg_color, text_color))
+    draw_labels(imgcv, labels, font_scale, space, thickness)
+    labeled = Frame(imgcv)
+    artifacts.save_image(output_path, labeled)
+    return labeled
+
+# Subareas of a grid cell and their position in quarters of the cell width and height
+GRID_SUBAREAS = ["top-left", "top", "top-right", "left", "center", "right", "bottom-left", "bottom", "bottom-right"]
+GRID_QUARTERS = [(1, 1), (2, 1), (3, 1), (1, 2), (2, 2), (3, 2), (1, 3), (2, 3), (3, 3)]
+
+
+class GridLayout:
+    # The geometry of the grid for one resolution, with the grid rendered once into an overlay and its alpha channel, so
+    # that drawing the grid on a frame is a single composite
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.unit_width = grid_unit_len(width)
+        self.unit_height = grid_unit_len(height)
+        self.rows = height // self.unit_height
+        self.cols = width // self.unit_width
+        # Rendering onto black gives the colours premultiplied by their coverage, rendering in white onto black gives
+        # the coverage itself, anti-aliased edges included
+        overlay = np.zeros((height, width, 3), np.uint8)
+        alpha = np.zeros((height, width), np.uint8)
+        self.render(overlay, (255, 116, 113), (0, 0, 0))
+        self.render(alpha, 255, 255)
+        # Fully covered pixels are copied, only the edges are blended
+        self.overlay = overlay
+        self.opaque = np.where(alpha == 255, 255, 0).astype(np.uint8)
+        self.edges = np.flatnonzero((alpha > 0) & (alpha < 255))
+        self.edge_colors = overlay.reshape(-1, 3)[self.edges].astype(np.float32)
+        self.edge_weights = 1 - alpha.ravel()[self.edges, None].astype(np.float32) / 255
+
+    def render(self, image, color, shadow):
+        thick = int(self.unit_width // 50)
+        for i in range(self.rows):
+            for j in range(self.cols):
+                label = i * self.cols + j + 1
+                left = int(j * self.unit_width)
+                top = int(i * self.unit_height)
+                right = int((j + 1) * self.unit_width)
+                bottom = int((i + 1) * self.unit_height)
+                cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
+                cv2.putText(image, str(label), (left + int(self.unit_width * 0.05) + 3,
+                                                top + int(self.unit_height * 0.3) + 3), 0,
+                            int(0.01 * self.unit_width), shadow, thick)
+                cv2.putText(image, str(label), (left + int(self.unit_width * 0.05), top + int(self.unit_height * 0.3)),
+                            0, int(0.01 * self.unit_width), color, thick)
+
+    def apply(self, image):
+        cv2.copyTo(self.overlay, self.opaque, image)
+        pixels = image.reshape(-1, 3)
+        pixels[self.edges] = (pixels[self.edges] * self.edge_weights + self.edge_colors + 0.5).astype(np.uint8)
+        return image
+
+
+def grid_unit_len(n):
+    for i in range(120, min(n, 180) + 1):
+        if n % i == 0:
+            return i
+    return 120
+
+
+grid_layouts = {}
+grid_points_cache = {}
+grid_cache_lock = threading.Lock()
+
+
+def get_grid_layout(width, height):
+    # The resolution does not change during a session, so the grid is only built once
+    with grid_cache_lock:
+        if (width, height) not in grid_layouts:
+            grid_layouts[(width, height)] = GridLayout(width, height)
+        return grid_layouts[(width, height)]
+
+
+def grid_points(rows, cols, width, height):
+    # Screen coordinates of every subarea of every grid cell, indexed by area - 1 and the position of the subarea in
+    # GRID_SUBAREAS
+    key = (rows, cols, width, height)
+    with grid_cache_lock:
+        if key not in grid_points_cache:
+            cell_width, cell_height = width // cols, height // rows
+            areas = np.arange(rows * cols)
+            quarters = np.array(GRID_QUARTERS)
+            x = (areas % cols * cell_width)[:, None] + cell_width * quarters[:, 0] // 4
+            y = (areas // cols * cell_height)[:, None] + cell_height * quarters[:, 1] // 4
+            grid_points_cache[key] = np.stack([x, y], axis=-1)
+        return grid_points_cache[key]
+
+
+def draw_grid(img, output_path):
+    image = read_image(img)
     height, width, _ = image.shape
-    color = (255, 116, 113)
-    unit_height = get_unit_len(height)
-    if unit_height < 0:
-        unit_height = 120
-    unit_width = get_unit_len(width)
-    if unit_width < 0:
-        unit_width = 120
-    thick = int(unit_width // 50)
-    rows = height // unit_height
-    cols = width // unit_width
-    for i in range(rows):
-        for j in range(cols):
-            label = i * cols + j + 1
-            left = int(j * unit_width)
-            top = int(i * unit_height)
-            right = int((j + 1) * unit_width)
-            bottom = int((i + 1) * unit_height)
-            cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05) + 3, top + int(unit_height * 0.3) + 3), 0,
-                        int(0.01 * unit_width), (0, 0, 0), thick)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05), top + int(unit_height * 0.3)), 0,
-                        int(0.01 * unit_width), color, thick)
-    cv2.imwrite(output_path, image)
-    return rows, cols
-
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
+    layout = get_grid_layout(width, height)
+    grid = Frame(layout.apply(image))
+    artifacts.save_image(output_path, grid)
+    return layout.rows, layout.cols, grid
+
+
+def encode_image(image):
+    if isinstance(image, Frame):
+        return base64.b64encode(image.data).decode('utf-8')
+    with open(image, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+IMAGE_FORMATS = {"png": (".png", "image/png"), "jpeg": (".jpg", "image/jpeg"), "webp": (".webp", "image/webp")}
+
+
+class PreparedImage:
+    def __init__(self, data, ext, mime, width, height):
+        self.data = data
+        self.ext = ext
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self._data_url = None
+
+    @property
+    def data_url(self):
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime};base64,{base64.b64encode(self.data).decode('utf-8')}"
+        return self._data_url
+
+    @property
+    def nbytes(self):
+        return len(self.data) + (len(self._data_url) if self._data_url else 0)
+
+
+def prepare_image(image, max_short_side=0, max_long_side=0, max_pixels=0, image_format="png", quality=90):
+    # Scale the image down to the largest size the model looks at and compress it for the upload. A limit of 0 is
+    # no limit.
+    frame = image if isinstance(image, Frame) else Frame(path=image)
+    ext, mime = IMAGE_FORMATS[image_format]
+    width, height = frame.size
+    scale = 1
+    if max_short_side:
+        scale = min(scale, max_short_side / min(width, height))
+    if max_long_side:
+        scale = min(scale, max_long_side / max(width, height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+    if scale >= 1 and image_format == "png" and frame.data[:8] == b"\x89PNG\r\n\x1a\n":
+        return PreparedImage(frame.data, ext, mime, width, height)
+    img = frame.image
+    if scale < 1:
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    if image_format == "jpeg":
+        # Keep the colour at full resolution, subsampling it smears the edges of the coloured labels
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality,
+                  cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+    elif image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = []
+    _, buf = cv2.imencode(ext, img, params)
+    return PreparedImage(buf.tobytes(), ext, mime, width, height)
+
+
+def image_digest(frame):
+    # Frames held in memory are hashed by their pixels, which do not depend on whether the frame was already encoded
+    # for saving, the others by their file
+    if not frame.decoded:
+        return hashlib.sha1(frame.data).hexdigest()
+    pixels = frame.raw if frame.raw is not None else frame.image
+    return hashlib.sha1(pixels.tobytes()).hexdigest()
+
+
+class ImageCache:
+    # Prepared uploads keyed by the content of the source image and the preparation settings, so that an image sent
+    # again, e.g. the screenshot before an action that goes into both the action and the reflection request, is only
+    # scaled, compressed and base64 encoded once. The least recently used entries are evicted beyond max_bytes.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def prepare(self, image, *args):
+        # Returns the prepared image and whether it came from the cache, the arguments are those of prepare_image
+        frame = image if isinstance(image, Frame) else Frame(path=image)
+        key = (image_digest(frame),) + args
+        with self.lock:
+            prepared = self.entries.get(key)
+            if prepared is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return prepared, True
+            self.misses += 1
+        prepared = prepare_image(frame, *args)
+        # Encode it outside of the lock
+        prepared.data_url
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = prepared
+                self.size += prepared.nbytes
+                while self.size > self.max_bytes and self.entries:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= evicted.nbytes
+        return prepared, False
+
+    def summary(self):
+        with self.lock:
+            return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} images of {self.size / 1024:.0f} KB"
+
+
+def append_text(path, text):
+    with open(path, "a") as f:
+        f.write(text)
+
+
+class ArtifactWriter:
+    # Persists screenshots and log lines on a background thread, which keeps the disk off the path between the model
+    # reply and the next action. Jobs run in the order they were submitted, so lines appended to the same file stay in
+    # order. The queue is bounded, when the disk falls behind the callers wait instead of piling up frames in memory.
+    def __init__(self, max_pending=16):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.failures = 0
+
+    def submit(self, job, *args):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((job, args))
+
+    def run(self):
+        while True:
+            job, args = self.queue.get()
+            try:
+                job(*args)
+            except Exception as e:
+                self.failures += 1
+                print_with_color(f"ERROR: failed to write {args[0]}: {e}", "red")
+            finally:
+                self.queue.task_done()
+
+    def save_image(self, path, image):
+        # The image is written as it is when the job runs, so it must not be drawn on after it was handed over
+        frame = image if isinstance(image, Frame) else Frame(image)
+        self.submit(frame.save, path)
+
+    def append(self, path, text):
+        self.submit(append_text, path, text)
+
+    def flush(self):
+        # Wait until everything submitted so far is on disk
+        self.queue.join()
+
+
+artifacts = ArtifactWriter()
+atexit.register(artifacts.flush)
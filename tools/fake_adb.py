@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# A stand-in for the adb binary that emulates one or more devices on the host, so the controller, the session mode and
+# the fleet mode can be exercised without a phone. Link it as "adb" into a directory that comes first on PATH:
+#
+#   mkdir -p /tmp/fakebin && ln -sf "$(pwd)/tools/fake_adb.py" /tmp/fakebin/adb && export PATH=/tmp/fakebin:$PATH
+#
+# Device shell commands run in a real host shell, with stubs for the Android tools the agent uses (input, screencap,
+# uiautomator, wm, getprop, dumpsys, settings, am and screenrecord) put first on its PATH. The stubs serve the
+# fixtures found in FAKE_ADB_HOME: screen.png for screenshots, ui.xml for hierarchy dumps and rec.h264 for the screen
+# recording, which fake_recording.py encodes. A synthetic screenshot and hierarchy are generated when there are none,
+# and the raw screenshot is converted from screen.png. Every input is appended to input.log together with the serial
+# of the device it was sent to.
+#
+# Environment:
+#   FAKE_ADB_HOME      fixture and state directory, a temporary directory by default
+#   FAKE_ADB_DEVICES   comma separated serials of the emulated devices, emulator-5554 by default
+#   FAKE_ADB_SIZE      screen size, 1080x2400 by default
+#   FAKE_ADB_DENSITY   screen density, 420 by default
+#   FAKE_ADB_FOCUS     focused activity reported by dumpsys, com.example/.MainActivity by default
+#   FAKE_ADB_IME       default input method, the stock keyboard by default
+#   FAKE_ADB_DELAY     seconds every screenshot and dump takes, 0 by default
+#   FAKE_ADB_INPUT_DELAY  seconds every input command takes, 0 by default
+#   FAKE_ADB_FORWARD_PORT  local port that "adb forward" reports, where fake_hierarchy_service.py listens
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DEVICE_TOOLS = ("input", "screencap", "uiautomator", "wm", "getprop", "dumpsys", "settings", "am", "screenrecord")
+
+HOME = os.environ.get("FAKE_ADB_HOME") or os.path.join(tempfile.gettempdir(), "fake_adb")
+DEVICES = os.environ.get("FAKE_ADB_DEVICES", "emulator-5554").split(",")
+WIDTH, HEIGHT = map(int, os.environ.get("FAKE_ADB_SIZE", "1080x2400").split("x"))
+DENSITY = os.environ.get("FAKE_ADB_DENSITY", "420")
+FOCUS = os.environ.get("FAKE_ADB_FOCUS", "com.example/.MainActivity")
+IME = os.environ.get("FAKE_ADB_IME", "com.android.inputmethod.latin/.LatinIME")
+DELAY = float(os.environ.get("FAKE_ADB_DELAY", "0"))
+INPUT_DELAY = float(os.environ.get("FAKE_ADB_INPUT_DELAY", "0"))
+
+
+def fail(message, code=1):
+    sys.stderr.write(message + "\n")
+    sys.exit(code)
+
+
+def device_path(path):
+    # Paths on the device live under the sdcard directory of the fixture home
+    return os.path.join(HOME, "device", path.lstrip("/"))
+
+
+def synthetic_screen():
+    # OpenCV and NumPy are only imported where they are needed, the stubs start this script for every device command
+    # and should cost about as little as the real tools
+    import cv2
+    import numpy as np
+    image = np.full((HEIGHT, WIDTH, 3), 245, np.uint8)
+    for i, y in enumerate(range(200, HEIGHT - 200, 180)):
+        cv2.rectangle(image, (60, y), (WIDTH - 60, y + 140), (200, 120 + i * 10 % 100, 60), -1)
+        cv2.putText(image, f"Item {i}", (100, y + 90), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+    return image
+
+
+def synthetic_hierarchy():
+    nodes = []
+    for i, y in enumerate(range(200, HEIGHT - 200, 180)):
+        nodes.append(f'<node index="{i}" text="Item {i}" resource-id="com.example:id/item" '
+                     f'class="android.widget.TextView" package="com.example" content-desc="" checkable="false" '
+                     f'checked="false" clickable="true" enabled="true" focusable="true" focused="false" '
+                     f'scrollable="false" long-clickable="false" password="false" selected="false" '
+                     f'bounds="[60,{y}][{WIDTH - 60},{y + 140}]" />')
+    return "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">" \
+           "<node index=\"0\" text=\"\" resource-id=\"\" class=\"android.widget.FrameLayout\" " \
+           "package=\"com.example\" content-desc=\"\" clickable=\"false\" focusable=\"false\" " \
+           f"bounds=\"[0,0][{WIDTH},{HEIGHT}]\">{''.join(nodes)}</node></hierarchy>"
+
+
+def fixture(name):
+    path = os.path.join(HOME, name)
+    if os.path.exists(path):
+        return path
+    os.makedirs(HOME, exist_ok=True)
+    tmp_path = os.path.join(HOME, f".{os.getpid()}.{name}")
+    if name == "screen.png":
+        import cv2
+        cv2.imwrite(tmp_path, synthetic_screen())
+    elif name == "ui.xml":
+        with open(tmp_path, "w") as f:
+            f.write(synthetic_hierarchy())
+    elif name == "screen.raw":
+        with open(tmp_path, "wb") as f:
+            f.write(raw_screen())
+    else:
+        return None
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_fixture(name):
+    path = fixture(name)
+    if path is None:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def raw_screen():
+    import cv2
+    import numpy as np
+    image = cv2.imread(fixture("screen.png"), cv2.IMREAD_COLOR)
+    height, width = image.shape[:2]
+    rgba = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+    # Width, height and pixel format (1 is RGBA_8888) in front of the pixels, as screencap writes them
+    return np.array([width, height, 1], "<u4").tobytes() + rgba.tobytes()
+
+
+def log_input(line):
+    os.makedirs(HOME, exist_ok=True)
+    with open(os.path.join(HOME, "input.log"), "a") as f:
+        f.write(f"{os.environ.get('FAKE_ADB_SERIAL', '')}: {line}\n")
+
+
+def write_output(data, path=None):
+    if path and path != "/dev/tty":
+        os.makedirs(os.path.dirname(device_path(path)), exist_ok=True)
+        with open(device_path(path), "wb") as f:
+            f.write(data)
+        return
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+
+def run_tool(tool, args):
+    # Emulates one Android tool inside the fake device shell
+    if tool == "input":
+        time.sleep(INPUT_DELAY)
+        log_input("input " + " ".join(args))
+    elif tool == "am":
+        time.sleep(INPUT_DELAY)
+        log_input("am " + " ".join(args))
+        # Like on a real device the broadcast succeeds whether or not anything receives it
+        print("Broadcasting: Intent { act=%s flg=0x400000 }" % (args[2] if len(args) > 2 else ""))
+        print("Broadcast completed: result=0")
+    elif tool == "screencap":
+        time.sleep(DELAY)
+        paths = [arg for arg in args if not arg.startswith("-")]
+        data = read_fixture("screen.png" if "-p" in args else "screen.raw")
+        write_output(data, paths[0] if paths else None)
+    elif tool == "uiautomator":
+        time.sleep(DELAY)
+        if args[:1] != ["dump"]:
+            fail(f"uiautomator: unknown command {' '.join(args)}")
+        path = args[1] if len(args) > 1 else "/sdcard/window_dump.xml"
+        write_output(read_fixture("ui.xml"), path)
+        print(f"UI hierchary dumped to: {path}", flush=True)
+    elif tool == "wm":
+        if args[:1] == ["size"]:
+            print(f"Physical size: {WIDTH}x{HEIGHT}")
+        elif args[:1] == ["density"]:
+            print(f"Physical density: {DENSITY}")
+    elif tool == "getprop":
+        props = {"ro.build.version.sdk": "33", "ro.build.fingerprint": "fake/sdk_phone64/emu64:13/TE1A/1:userdebug"}
+        print(props.get(args[0], "") if args else "")
+    elif tool == "dumpsys":
+        service = args[0] if args else ""
+        if service == "window":
+            print(f"  mCurrentFocus=Window{{1a2b u0 {FOCUS}}}")
+            print(f"  mFocusedApp=ActivityRecord{{3c4d u0 {FOCUS} t12}}")
+        elif service == "activity":
+            print(f"    mResumedActivity: ActivityRecord{{3c4d u0 {FOCUS} t12}}")
+        elif service == "input":
+            print("      SurfaceOrientation: 0")
+    elif tool == "settings":
+        if args[:3] == ["get", "secure", "default_input_method"]:
+            print(IME)
+    elif tool == "screenrecord":
+        recording = fixture("rec.h264")
+        if recording is None:
+            fail("screenrecord: no recording in " + HOME)
+        with open(recording, "rb") as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        # A real recording keeps going until its time limit, hold the stream open for a while
+        time.sleep(float(os.environ.get("FAKE_ADB_RECORD_HOLD", "3")))
+
+
+def tool_dir():
+    # The stubs call back into this script, they are written once per fixture home
+    bin_dir = os.path.join(HOME, "bin")
+    if not os.path.isdir(bin_dir):
+        os.makedirs(HOME, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=HOME)
+        for tool in DEVICE_TOOLS:
+            path = os.path.join(tmp_dir, tool)
+            with open(path, "w") as f:
+                f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.abspath(__file__)}\" --tool {tool} \"$@\"\n")
+            os.chmod(path, 0o755)
+        try:
+            os.rename(tmp_dir, bin_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+    return bin_dir
+
+
+def device_shell(serial, command=None, **kwargs):
+    env = dict(os.environ, PATH=tool_dir() + os.pathsep + os.environ.get("PATH", ""), FAKE_ADB_SERIAL=serial,
+               FAKE_ADB_HOME=HOME)
+    if command is None:
+        return subprocess.call(["sh"], env=env, **kwargs)
+    return subprocess.call(["sh", "-c", command], env=env, **kwargs)
+
+
+def main(argv):
+    if argv[:1] == ["--tool"]:
+        run_tool(argv[1], argv[2:])
+        return 0
+    serial = None
+    if argv[:1] == ["-s"]:
+        serial = argv[1]
+        argv = argv[2:]
+    if not argv:
+        fail("usage: adb [-s SERIAL] COMMAND")
+    command, args = argv[0], argv[1:]
+    if command == "devices":
+        print("List of devices attached")
+        for device in DEVICES:
+            print(f"{device}\tdevice")
+        print()
+        return 0
+    if serial is None:
+        if len(DEVICES) > 1:
+            fail("adb: more than one device/emulator")
+        serial = DEVICES[0]
+    if serial not in DEVICES:
+        fail(f"adb: device '{serial}' not found")
+    if command == "shell":
+        # Like adb, several arguments are joined into one command line for the device shell
+        return device_shell(serial, " ".join(args) if args else None)
+    if command == "exec-out":
+        return device_shell(serial, " ".join(args))
+    if command == "pull":
+        if not os.path.exists(device_path(args[0])):
+            fail(f"adb: error: failed to stat remote object '{args[0]}': No such file or directory")
+        shutil.copyfile(device_path(args[0]), args[1])
+        print(f"{args[0]}: 1 file pulled.")
+        return 0
+    if command == "forward":
+        if args[:1] == ["--remove"]:
+            return 0
+        port = os.environ.get("FAKE_ADB_FORWARD_PORT")
+        if not port:
+            fail("adb: error: cannot bind listener: nothing listens on the device port")
+        print(port)
+        return 0
+    if command in ("reconnect", "wait-for-device"):
+        return 0
+    fail(f"adb: unknown command {command}")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+import argparse
+import os
+import socketserver
+import struct
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from fake_adb import DEVICES, device_path, device_shell
+from utils import print_with_color
+
+# A stand-in for the adb server that speaks the host protocol for the devices emulated by fake_adb.py, so that the
+# socket transport (ADB_TRANSPORT: "socket") can be exercised without a phone. It understands host:devices,
+# host:transport:<serial> followed by shell:, exec: or sync: with RECV and QUIT, which is all AdbClient uses.
+# Device commands and fixtures are the same as with fake_adb.py and configured through the same environment.
+arg_desc = "Fake adb server for the devices emulated by fake_adb.py"
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=5037)
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class AdbRequestHandler(socketserver.BaseRequestHandler):
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionClosed()
+            data += chunk
+        return bytes(data)
+
+    def recv_request(self):
+        length = int(self.recv_exactly(4), 16)
+        return self.recv_exactly(length).decode()
+
+    def okay(self, payload=None):
+        self.request.sendall(b"OKAY")
+        if payload is not None:
+            self.request.sendall(b"%04x" % len(payload) + payload)
+
+    def fail(self, message):
+        message = message.encode()
+        self.request.sendall(b"FAIL" + b"%04x" % len(message) + message)
+
+    def handle(self):
+        try:
+            request = self.recv_request()
+            if request == "host:version":
+                self.okay(b"0029")
+            elif request == "host:devices":
+                self.okay("".join(f"{device}\tdevice\n" for device in DEVICES).encode())
+            elif request.startswith("host:transport:"):
+                serial = request[len("host:transport:"):]
+                if serial not in DEVICES:
+                    self.fail(f"device '{serial}' not found")
+                    return
+                self.okay()
+                self.handle_service(serial, self.recv_request())
+            else:
+                self.fail(f"unknown host service {request}")
+        except (ConnectionClosed, OSError):
+            pass
+
+    def handle_service(self, serial, service):
+        # Like adbd, the output is streamed into the connection while the command runs and the connection is closed
+        # when it ends. The legacy shell service mixes stderr into the output, exec only passes stdout on.
+        if service.startswith("shell:"):
+            self.okay()
+            device_shell(serial, service[len("shell:"):], stdin=subprocess.DEVNULL, stdout=self.request.fileno(),
+                         stderr=subprocess.STDOUT)
+        elif service.startswith("exec:"):
+            self.okay()
+            device_shell(serial, service[len("exec:"):], stdin=subprocess.DEVNULL, stdout=self.request.fileno(),
+                         stderr=subprocess.DEVNULL)
+        elif service == "sync:":
+            self.okay()
+            self.handle_sync()
+        else:
+            self.fail(f"unknown service {service}")
+
+    def handle_sync(self):
+        while True:
+            sync_id = self.recv_exactly(4)
+            length = struct.unpack("<I", self.recv_exactly(4))[0]
+            if sync_id == b"QUIT":
+                return
+            path = self.recv_exactly(length).decode()
+            if sync_id != b"RECV":
+                self.sync_fail(f"unsupported sync request {sync_id.decode(errors='replace')}")
+                return
+            if not os.path.isfile(device_path(path)):
+                self.sync_fail(f"remote object '{path}' does not exist")
+                continue
+            with open(device_path(path), "rb") as f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    self.request.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+            self.request.sendall(b"DONE" + struct.pack("<I", 0))
+
+    def sync_fail(self, message):
+        message = message.encode()
+        self.request.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    args = vars(parser.parse_args())
+    server = FakeAdbServer((args["host"], args["port"]), AdbRequestHandler)
+    print_with_color(f"Fake adb server for {', '.join(DEVICES)} listening on {args['host']}:{args['port']}", "yellow")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
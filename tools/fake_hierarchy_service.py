@@ -0,0 +1,71 @@
+import argparse
+import http.server
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from config import load_config
+from fake_adb import read_fixture
+from utils import print_with_color
+
+# A stand-in for the on-device hierarchy service (XML_BACKEND: "service"), so that the service backend and its
+# fallback to uiautomator dump can be exercised without a phone. It answers GET requests on HIERARCHY_SERVICE_PATH with
+# the recorded hierarchy that the uiautomator stub of fake_adb.py serves too, FAKE_ADB_HOME/ui.xml or a synthetic one.
+# The file is read again for every request, so replacing it changes the screen. fake_adb.py reports
+# FAKE_ADB_FORWARD_PORT as the forwarded port, so start both with the same port:
+#
+#   FAKE_ADB_FORWARD_PORT=6790 python tools/fake_hierarchy_service.py
+#
+# Stopping the service while the agent runs shows the fallback to uiautomator dump.
+configs = load_config()
+
+arg_desc = "Fake hierarchy service for the devices emulated by fake_adb.py"
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=int(os.environ.get("FAKE_ADB_FORWARD_PORT") or 6790),
+                    help="FAKE_ADB_FORWARD_PORT by default")
+parser.add_argument("--xml", help="Hierarchy to serve instead of the ui.xml fixture of fake_adb.py")
+parser.add_argument("--delay", type=float, default=0, help="Seconds every request takes")
+
+
+class HierarchyRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != configs["HIERARCHY_SERVICE_PATH"]:
+            self.send_error(404)
+            return
+        if self.server.xml_path:
+            with open(self.server.xml_path, "rb") as f:
+                data = f.read()
+        else:
+            data = read_fixture("ui.xml")
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHierarchyService(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, xml_path=None, delay=0):
+        super().__init__(address, HierarchyRequestHandler)
+        self.xml_path = xml_path
+        self.delay = delay
+
+
+if __name__ == "__main__":
+    args = vars(parser.parse_args())
+    server = FakeHierarchyService((args["host"], args["port"]), args["xml"], args["delay"])
+    print_with_color(f"Fake hierarchy service listening on http://{args['host']}:{args['port']}"
+                     f"{configs['HIERARCHY_SERVICE_PATH']}", "yellow")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
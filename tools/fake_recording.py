@@ -0,0 +1,74 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from fake_adb import HOME
+from frame_stream import FrameStream
+from utils import print_with_color
+
+# A stand-in for the H.264 stream of "adb exec-out screenrecord --output-format=h264 -", so that the frame stream
+# (FRAME_STREAM: true) can be exercised without a phone. The recording is encoded with ffmpeg the way screenrecord
+# encodes it, as a raw Annex B stream without B-frames, and written to FAKE_ADB_HOME/rec.h264 where the screenrecord
+# stub of fake_adb.py serves it from. It shows a screenshot scrolling up and down when one is given, the ffmpeg test
+# pattern otherwise. With --check the recording is decoded through FrameStream, like the controller does.
+arg_desc = "Encode a screen recording for the screenrecord stub of fake_adb.py"
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+parser.add_argument("--output", default=os.path.join(HOME, "rec.h264"))
+parser.add_argument("--image", help="Screenshot to scroll through, e.g. FAKE_ADB_HOME/screen.png")
+parser.add_argument("--size", default="528x1200", help="Size of the recording, the controller records at "
+                                                       "FRAME_STREAM_SCALE of the screen rounded down to 16")
+parser.add_argument("--fps", type=int, default=30)
+parser.add_argument("--duration", type=float, default=3)
+parser.add_argument("--ffmpeg", default="ffmpeg")
+parser.add_argument("--check", action="store_true", help="Decode the recording and report the frame rate")
+args = vars(parser.parse_args())
+
+width, height = map(int, args["size"].split("x"))
+if args["image"]:
+    # Scale the screenshot to twice the height of the recording and pan over it, one pass per second
+    source = ["-loop", "1", "-framerate", str(args["fps"]), "-i", args["image"], "-vf",
+              f"scale={width}:{height * 2},crop={width}:{height}:0:'(1-abs(mod(t,2)-1))*{height}'"]
+else:
+    source = ["-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={args['fps']}"]
+command = [args["ffmpeg"], "-loglevel", "error", "-y"] + source + \
+          ["-t", str(args["duration"]), "-c:v", "libx264", "-profile:v", "baseline", "-bf", "0", "-pix_fmt", "yuv420p",
+           "-f", "h264", args["output"]]
+os.makedirs(os.path.dirname(os.path.abspath(args["output"])), exist_ok=True)
+try:
+    result = subprocess.run(command)
+except OSError as e:
+    print_with_color(f"ERROR: ffmpeg could not be started: {e}", "red")
+    sys.exit(1)
+if result.returncode != 0:
+    print_with_color("ERROR: ffmpeg failed to encode the recording", "red")
+    sys.exit(1)
+expected = int(args["duration"] * args["fps"])
+print_with_color(f"{args['output']}: {width}x{height}, {expected} frames, "
+                 f"{os.path.getsize(args['output']) / 1e3:.0f} kB", "yellow")
+
+if args["check"]:
+    # Feed the file once and stop, the stream would otherwise reopen it like a screenrecord that reached its limit
+    opened = []
+
+    def open_source():
+        if opened:
+            stream.stopped.set()
+            return "ERROR"
+        opened.append(time.perf_counter())
+        return open(args["output"], "rb")
+
+    stream = FrameStream(open_source, width, height, decoder=args["ffmpeg"]).start()
+    first_frame = None
+    while stream.running:
+        if first_frame is None and stream.latest_frame() is not None:
+            first_frame = time.perf_counter()
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - opened[0] if opened else 0
+    if stream.frame_count != expected or first_frame is None:
+        print_with_color(f"ERROR: decoded {stream.frame_count} of {expected} frames", "red")
+        sys.exit(1)
+    print_with_color(f"decoded {stream.frame_count} frames in {elapsed:.2f} s ({stream.frame_count / elapsed:.0f} "
+                     f"fps), first frame after {(first_frame - opened[0]) * 1000:.0f} ms", "cyan")